@@ -0,0 +1,137 @@
+"""Corrections for BME680 readings. They're applied to numpy arrays, so a whole window of samples, or a stored
+history of thousands of them, is corrected at once. The calibration is a json file such as:
+
+    {
+        "altitude": 266,
+        "temperature_offset": {"constant": 5.2, "cpu_temperature": [0, 0.04], "heater": [0, 1.5]}
+    }
+
+The temperature offset is `constant` plus a polynomial (coefficients lowest degree first) of each other listed
+reading, i.e: the CPU temperature or the gas heater's state. Use `fit` to fit one against a reference thermometer.
+
+    python3 corrections.py fit samples.jsonl --by cpu_temperature > calibration.json
+    python3 corrections.py backfill history.jsonl --calibration calibration.json > corrected.jsonl
+"""
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+FIELDS = ("temperature", "pressure", "humidity")
+# The sensor sits right next to the pi, so it reads a few degrees too hot
+DEFAULT_CALIBRATION = {"altitude": 266, "temperature_offset": {"constant": 7}}
+
+
+def load_calibration(path=None):
+    """Load a calibration file on top of the defaults, which are used as is if `path` is None"""
+    calibration = json.loads(json.dumps(DEFAULT_CALIBRATION))
+    if path:
+        with open(path, "r") as f:
+            calibration.update(json.load(f))
+    return calibration
+
+
+def as_columns(readings):
+    """Turn readings, either a list of {name: value} records or a dict of sequences, into a dict of float
+    arrays. Records missing a value get a NaN, non numeric values (i.e: nested min/max) are left out."""
+    if isinstance(readings, dict):
+        return {name: np.asarray(values, dtype=float) for name, values in readings.items()}
+    names = {
+        name
+        for record in readings
+        for name, value in record.items()
+        if isinstance(value, (int, float, bool)) or value is None
+    }
+    return {name: np.array([record.get(name) for record in readings], dtype=float) for name in names}
+
+
+def temperature_offset(columns, calibration):
+    """How much the sensor overestimates the temperature, for each reading"""
+    terms = calibration["temperature_offset"]
+    offset = np.full_like(columns["temperature"], float(terms.get("constant", 0)))
+    for name, coefficients in terms.items():
+        if name != "constant":
+            if name not in columns:
+                raise KeyError(f"Calibration needs `{name}` readings which are missing.")
+            offset += np.polynomial.polynomial.polyval(columns[name], coefficients)
+    return offset
+
+
+def sea_level_pressure(pressure, temperature, altitude):
+    """
+    Adjust pressure based on your altitude.
+
+    credits to @cubapp https://gist.github.com/cubapp/23dd4e91814a995b8ff06f406679abcf
+    """
+    return pressure + ((pressure * 9.80665 * altitude) / (287 * (273 + temperature + (altitude / 400))))
+
+
+def correct(readings, calibration=None):
+    """Correct raw readings (see `as_columns`), return a dict of arrays where temperature, humidity
+    and pressure are corrected and any other reading (i.e: time, cpu_temperature) is passed through."""
+    columns = as_columns(readings)
+    calibration = calibration or load_calibration()
+    temperature, humidity, pressure = (columns[field] for field in ("temperature", "humidity", "pressure"))
+
+    # correct temperature and humidity using an offset
+    corrected_temperature = temperature - temperature_offset(columns, calibration)
+    dewpoint = temperature - ((100 - humidity) / 5)
+    corrected_humidity = 100 - (5 * (corrected_temperature - dewpoint))
+    corrected_pressure = sea_level_pressure(pressure, corrected_temperature, calibration["altitude"])
+    return {
+        **columns,
+        "temperature": corrected_temperature,
+        "pressure": corrected_pressure,
+        "humidity": corrected_humidity,
+    }
+
+
+def fit(measured, reference, degree=1, **covariates):
+    """Least squares fit of the temperature offset (`measured` - `reference`) as a polynomial of `degree` in each
+    covariate, i.e: `fit(raw, thermometer, cpu_temperature=cpu)`. Returns the `temperature_offset` calibration."""
+    measured, reference = np.asarray(measured, dtype=float), np.asarray(reference, dtype=float)
+    names = list(covariates)
+    design = [np.ones_like(measured)]
+    for name in names:
+        design.extend(np.asarray(covariates[name], dtype=float) ** power for power in range(1, degree + 1))
+    coefficients, *_ = np.linalg.lstsq(np.column_stack(design), measured - reference, rcond=None)
+    terms = {"constant": round(float(coefficients[0]), 6)}
+    for i, name in enumerate(names):
+        terms[name] = [0.0] + [round(float(c), 6) for c in coefficients[1 + i * degree : 1 + (i + 1) * degree]]
+    return terms
+
+
+def _load_records(path):
+    """Read json lines, published windows keep their raw readings under `raw`"""
+    with open(path, "r") if path != "-" else sys.stdin as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [{**record.get("raw", record), "time": record.get("time")} for record in records]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit BME680 calibrations and correct stored readings")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="correct stored raw readings (json lines)")
+    backfill_parser.add_argument("readings", help="json lines of raw readings, `-` for stdin")
+    backfill_parser.add_argument("--calibration", help="calibration file, defaults are used if omitted")
+    fit_parser = subparsers.add_parser("fit", help="fit the temperature offset against a reference")
+    fit_parser.add_argument("readings", help="json lines of raw readings with a reference temperature")
+    fit_parser.add_argument("--reference", default="reference", help="name of the reference temperature")
+    fit_parser.add_argument("--by", action="append", default=[], help="reading the offset depends on")
+    fit_parser.add_argument("--degree", type=int, default=1, help="degree of the polynomial in each reading")
+    fit_parser.add_argument("--altitude", type=float, default=DEFAULT_CALIBRATION["altitude"], help="in meters")
+    args = parser.parse_args()
+
+    columns = as_columns(_load_records(args.readings))
+    if args.command == "backfill":
+        corrected = correct(columns, load_calibration(args.calibration))
+        names = sorted(corrected, key=lambda name: (name not in ("time", *FIELDS), name))
+        names = [name for name in names if not np.isnan(corrected[name]).all()]
+        for row in zip(*(corrected[name].tolist() for name in names)):
+            row = {name: None if np.isnan(value) else round(value, 2) for name, value in zip(names, row)}
+            print(json.dumps({**row, "time": int(row["time"])} if row.get("time") is not None else row))
+    else:
+        terms = fit(columns["temperature"], columns[args.reference], args.degree, **{n: columns[n] for n in args.by})
+        print(json.dumps({"altitude": args.altitude, "temperature_offset": terms}, indent=4))
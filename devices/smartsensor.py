@@ -1,35 +1,58 @@
 # See: https://github.com/pimoroni/pimoroni-pico/blob/main/micropython/examples/pico_enviro/enviro_all.py
 
+import argparse
+import collections
 import json
+import os
+import queue
+import random
+import signal
+import threading
+import time
 
-import bme680
+import corrections
+import numpy as np
 import paho.mqtt.client as mqtt
 
 BROKER_ADDR = "192.168.1.215"
+BROKER_PORT = 1883
 TOPIC_BASE = "home/bedroom/smartsensor1"
 CLIENT_NAME = "SMARTSENSOR1-RPI0"
 MAX_TRIES = 5
-TEMPERATURE_OFFSET = 7
-ALTITUDE = 266  # in meters?
+# Temperature offset and altitude used to correct readings, see corrections.py, the defaults are used if missing
+CALIBRATION_FILE = os.path.expanduser("~/smartsensor-calibration.json")
+CPU_TEMPERATURE_FILE = "/sys/class/thermal/thermal_zone0/temp"
+
+# Daemon mode: sample every SAMPLE_INTERVAL seconds, publish the mean/min/max of every WINDOW seconds
+SAMPLE_INTERVAL = 10
+WINDOW = 300
+QOS = 1
+# Windows that couldn't be published yet (i.e: broker is down) are kept here, at most BUFFER_SIZE of them
+BUFFER_FILE = os.path.expanduser("~/.smartsensor-buffer.jsonl")
+BUFFER_SIZE = 1000
 
 
 def on_connect(client, userdata, flags, rc):
     client.subscribe(f"{TOPIC_BASE}/set")
 
 
-def adjust_to_sea_pressure(pressure_hpa, temperature, altitude):
-    """
-    Adjust pressure based on your altitude.
+class FakeSensor:
+    """Stand-in for the BME680 which random walks around plausible indoor values, to test without the hardware"""
 
-    credits to @cubapp https://gist.github.com/cubapp/23dd4e91814a995b8ff06f406679abcf
-    """
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.data = argparse.Namespace(temperature=28.0, humidity=40.0, pressure=980.0)
 
-    # Adjusted-to-the-sea barometric pressure
-    adjusted_hpa = pressure_hpa + ((pressure_hpa * 9.80665 * altitude) / (287 * (273 + temperature + (altitude / 400))))
-    return adjusted_hpa
+    def get_sensor_data(self):
+        self.data.temperature += self.random.gauss(0, 0.05)
+        self.data.humidity = min(100, max(0, self.data.humidity + self.random.gauss(0, 0.2)))
+        self.data.pressure += self.random.gauss(0, 0.1)
+        return True
 
 
-if __name__ == "__main__":
+def open_sensor():
+    import bme680
+
     try:
         sensor = bme680.BME680(bme680.I2C_ADDR_PRIMARY)
     except (RuntimeError, IOError):
@@ -39,22 +62,160 @@ if __name__ == "__main__":
     sensor.set_pressure_oversample(bme680.OS_4X)
     sensor.set_temperature_oversample(bme680.OS_8X)
     sensor.set_filter(bme680.FILTER_SIZE_3)
+    return sensor
+
+
+def read(sensor):
+    """Take a raw reading, along with what the temperature offset may depend on (see corrections.py),
+    return None if the sensor has no new data"""
+    if not sensor.get_sensor_data():
+        return None
+
+    reading = {
+        "temperature": sensor.data.temperature,
+        "pressure": sensor.data.pressure,
+        "humidity": sensor.data.humidity,
+        "heater": float(getattr(sensor.data, "heat_stable", False)),
+    }
+    if os.path.exists(CPU_TEMPERATURE_FILE):
+        with open(CPU_TEMPERATURE_FILE, "r") as f:
+            reading["cpu_temperature"] = int(f.read()) / 1000
+    return reading
+
+
+def aggregate(samples, calibration):
+    """Correct a window of raw readings in one go and summarize it. The means keep the one-shot payload's keys
+    so existing home assistant templates (i.e: `value_json.temperature`) keep working, the mean raw readings
+    are kept too so history can be corrected again with a better calibration (see corrections.py backfill)."""
+    corrected, raw = corrections.correct(samples, calibration), corrections.as_columns(samples)
+    return {
+        **{field: round(float(np.mean(corrected[field])), 2) for field in corrections.FIELDS},
+        "min": {field: round(float(np.min(corrected[field])), 2) for field in corrections.FIELDS},
+        "max": {field: round(float(np.max(corrected[field])), 2) for field in corrections.FIELDS},
+        "raw": {name: round(float(np.mean(values)), 2) for name, values in sorted(raw.items())},
+        "samples": len(samples),
+        "time": int(time.time()),
+    }
+
+
+def load_buffer(path=BUFFER_FILE):
+    buffer = collections.deque(maxlen=BUFFER_SIZE)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            buffer.extend(json.loads(line) for line in f if line.strip())
+    return buffer
+
+
+def save_buffer(buffer, path=BUFFER_FILE):
+    """Persist unpublished windows so they survive a restart, the file is removed once they're all out"""
+    if not buffer:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(f"{path}.tmp", "w") as f:
+        f.writelines(json.dumps(item) + "\n" for item in buffer)
+    os.replace(f"{path}.tmp", path)
+
+
+def daemon(
+    sensor,
+    client,
+    broker=BROKER_ADDR,
+    port=BROKER_PORT,
+    interval=SAMPLE_INTERVAL,
+    window=WINDOW,
+    buffer_file=BUFFER_FILE,
+    calibration=None,
+):
+    """Keep the sensor and broker connection open, publish aggregated readings every `window` seconds.
+    While the broker is unreachable paho queues the (QoS 1) messages and reconnects in the background,
+    windows are also kept in a buffer file until acknowledged, so they survive a restart."""
+    stop, acked = threading.Event(), queue.Queue()
+    buffer, unacked = load_buffer(buffer_file), {}
 
+    def publish(data):
+        unacked[client.publish(TOPIC_BASE, json.dumps(data), qos=QOS).mid] = data
+
+    def drop_acknowledged():
+        # Paho calls on_publish from it's network thread, the buffer is only ever touched from this one
+        changed = False
+        while not acked.empty():
+            if (data := unacked.pop(acked.get(), None)) is not None and data in buffer:
+                buffer.remove(data)
+                changed = True
+        if changed:
+            save_buffer(buffer, buffer_file)
+
+    client.on_publish = lambda client, userdata, mid: acked.put(mid)
+    client.reconnect_delay_set(min_delay=1, max_delay=120)
+    client.connect_async(broker, port)
+    client.loop_start()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    for data in buffer:
+        publish(data)
+
+    samples, start = [], time.monotonic()
+    try:
+        while not stop.is_set():
+            if reading := read(sensor):
+                samples.append(reading)
+            if stop.wait(interval) or time.monotonic() - start >= window:
+                if samples:
+                    buffer.append(data := aggregate(samples, calibration))
+                    save_buffer(buffer, buffer_file)
+                    publish(data)
+                samples, start = [], time.monotonic()
+            drop_acknowledged()
+
+        # Give the last windows a chance to be acknowledged before disconnecting
+        deadline = time.monotonic() + 5
+        while len(unacked) > acked.qsize() and client.is_connected() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        drop_acknowledged()
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+
+def once(sensor, client, broker=BROKER_ADDR, port=BROKER_PORT, calibration=None):
+    """Take a single reading within MAX_TRIES and publish it, meant to be run periodically (i.e: cron)"""
+    client.connect(broker, port)
+    client.loop_start()
+    try:
+        for _ in range(MAX_TRIES):
+            if reading := read(sensor):
+                corrected = corrections.correct([reading], calibration)
+                data = {field: float(corrected[field][0]) for field in corrections.FIELDS}
+                client.publish(f"{TOPIC_BASE}", json.dumps(data), qos=QOS).wait_for_publish(timeout=10)
+                break
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish BME680 readings over MQTT")
+    parser.add_argument("--daemon", action="store_true", help="keep running, publish mean/min/max of each window")
+    parser.add_argument("--interval", type=float, default=SAMPLE_INTERVAL, help="seconds between samples")
+    parser.add_argument("--window", type=float, default=WINDOW, help="seconds aggregated into each publish")
+    parser.add_argument("--broker", default=BROKER_ADDR, help="address of the MQTT broker")
+    parser.add_argument("--port", type=int, default=BROKER_PORT, help="port of the MQTT broker")
+    parser.add_argument("--buffer", default=BUFFER_FILE, help="file unpublished windows are kept in")
+    parser.add_argument("--calibration", default=CALIBRATION_FILE, help="calibration file, see corrections.py")
+    parser.add_argument("--fake", action="store_true", help="use a simulated sensor instead of the BME680")
+    args = parser.parse_args()
+
+    sensor = FakeSensor() if args.fake else open_sensor()
+    calibration = corrections.load_calibration(args.calibration if os.path.exists(args.calibration) else None)
+    # Fail now, not at the end of the first window, if the calibration needs readings we don't take
+    if reading := read(sensor):
+        corrections.correct([reading], calibration)
     client = mqtt.Client(CLIENT_NAME)
     client.on_connect = on_connect
-    client.connect(BROKER_ADDR)
-
-    for _ in range(MAX_TRIES):
-        if sensor.get_sensor_data():
-            # correct temperature and humidity using an offset
-            corrected_temperature = sensor.data.temperature - TEMPERATURE_OFFSET
-            dewpoint = sensor.data.temperature - ((100 - sensor.data.humidity) / 5)
-            corrected_humidity = 100 - (5 * (corrected_temperature - dewpoint))
-            corrected_pressure = adjust_to_sea_pressure(sensor.data.pressure, corrected_temperature, ALTITUDE)
-            data = {
-                "temperature": corrected_temperature,
-                "pressure": corrected_pressure,
-                "humidity": corrected_humidity,
-            }
-            client.publish(f"{TOPIC_BASE}", json.dumps(data))
-            break
+
+    if args.daemon:
+        daemon(sensor, client, args.broker, args.port, args.interval, args.window, args.buffer, calibration)
+    else:
+        once(sensor, client, args.broker, args.port, calibration)
@@ -1,11 +1,13 @@
 # Run with: fab <task> -H <user>@<addr> --prompt-for-login-password --prompt-for-sudo-password
 from invoke import Collection
 
-from fabfile import backup, configure, install, misc, status
+from fabfile import backup, bench, configure, fleet, install, misc, status
 
 ns = Collection()
 ns.add_collection(backup)
+ns.add_collection(bench)
 ns.add_collection(configure)
+ns.add_collection(fleet)
 ns.add_collection(install)
 ns.add_collection(misc)
 ns.add_collection(status)
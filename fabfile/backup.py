@@ -1,21 +1,240 @@
+import asyncio
+import contextlib
 import datetime
-import glob
+import hashlib
+import json
 import os
+import posixpath
+import queue
+import shlex
+import shutil
+import subprocess
+import tarfile
+import tempfile
 import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
 from functools import partial
 from pathlib import Path
-from zipfile import ZipFile, ZipInfo
+from types import SimpleNamespace
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile, ZipInfo
 
 import dateutil
 import dateutil.parser
 import dateutil.tz
+import humanize
 import requests
-from fabric import task
 from tqdm.auto import tqdm
 
 from fabfile import status
-from fabfile.defaults import BACKUP_PATH, DCP, SERVICES_REMOTE_ROOT
-from fabfile.utils import _load_service_config, _read_file, _remote_walk, _total_files
+from fabfile.defaults import (
+    BACKUP_PATH,
+    DCP,
+    INDEX_FILE,
+    SERVICES_REMOTE_ROOT,
+    STORE_DIR,
+    STORE_PATH,
+    ZIP_BUFFER_SIZE,
+    ZIP_STREAM_SIZE,
+)
+from fabfile.utils import (
+    _clone_connection,
+    _diff_listings,
+    _feed_command,
+    _file_sha256,
+    _listing,
+    _load_service_config,
+    _previous_listing,
+    _read_file,
+    _remote_walk,
+    _resumable_get,
+    _resumable_put,
+    _stream_command,
+    task,
+)
+
+# Archives `restore_simple` knows how to stream back, in order of preference
+_ARCHIVE_FORMATS = ("zip", "tar.zst", "tar.gz")
+
+# Zip compression policy by file suffix: already compressed media and archives are stored as-is, text and databases
+# get the strongest deflate level. Anything else is deflated at the default level and stored if it doesn't shrink.
+_STORED_SUFFIXES = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".heic", ".ico",
+    ".mp3", ".m4a", ".aac", ".flac", ".ogg", ".opus", ".mp4", ".m4v", ".mkv", ".avi", ".webm",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".jar", ".woff", ".woff2", ".pdf",
+}  # fmt: skip
+_DENSE_SUFFIXES = {
+    ".db", ".sqlite", ".sqlite3", ".db-wal", ".db-shm", ".json", ".xml", ".yml", ".yaml", ".toml", ".ini", ".conf",
+    ".cfg", ".txt", ".log", ".csv", ".html", ".js", ".css", ".sql", ".nfo", ".srt",
+}  # fmt: skip
+
+
+def _compress_member(name, data):
+    """Compress `data` following the suffix policy of `name`, return (compress_type, payload, crc)"""
+    suffix = Path(name).suffix.lower()
+    if suffix in _STORED_SUFFIXES or not data:
+        return ZIP_STORED, data, zlib.crc32(data)
+    compressor = zlib.compressobj(9 if suffix in _DENSE_SUFFIXES else 6, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    if len(payload) >= len(data):
+        return ZIP_STORED, data, zlib.crc32(data)
+    return ZIP_DEFLATED, payload, zlib.crc32(data)
+
+
+def _write_precompressed(zf, zinfo, size, compress_type, payload, crc):
+    """Append a member whose `payload` was already compressed with `compress_type` to the open ZipFile `zf`"""
+    zinfo.compress_type, zinfo.file_size, zinfo.compress_size, zinfo.CRC = compress_type, size, len(payload), crc
+    with zf._lock:
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zinfo.header_offset = zf.fp.tell()
+        zf.fp.write(zinfo.FileHeader(size > ZIP64_LIMIT or len(payload) > ZIP64_LIMIT))
+        zf.fp.write(payload)
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        zf.start_dir = zf.fp.tell()
+
+
+def _stream_member(c, zf, zinfo, path, size):
+    """Copy a remote file into the open ZipFile `zf` as it downloads, for files too big to be read in memory"""
+    zinfo.compress_type = ZIP_STORED if Path(zinfo.filename).suffix.lower() in _STORED_SUFFIXES else ZIP_DEFLATED
+    zinfo.file_size = size
+    with c.sftp().open(path, "rb") as remote, zf.open(zinfo, "w") as member:
+        remote.prefetch()
+        shutil.copyfileobj(remote, member, 2**20)
+
+
+def _zip_backup(c, root, files, path, pbar, verbose, workers=None):
+    """Fetch `files` into the zip at `path`, compressing members on a local thread pool while the next ones download.
+    At most ZIP_BUFFER_SIZE bytes of members are held at once, files of ZIP_STREAM_SIZE or more are streamed."""
+    workers = workers or os.cpu_count() or 1
+    pending, buffered = [], 0
+
+    def flush(limit=None):
+        nonlocal buffered
+        while pending and (limit is None or buffered > limit):
+            zinfo, size, future = pending.pop(0)
+            _write_precompressed(zf, zinfo, size, *future.result())
+            buffered -= size
+
+    # zlib releases the GIL, so threads compress on all cores without pickling members to other processes
+    with ZipFile(path, "w") as zf, ThreadPoolExecutor(max_workers=workers) as executor:
+        for f in pbar(files):
+            if verbose == 2:
+                print(f"Fetching {f.path}...")
+            zinfo = ZipInfo(str(Path(f.path).relative_to(root)), time.localtime(f.mtime)[:6])
+            zinfo.external_attr = f.mode << 16
+            if f.size >= ZIP_STREAM_SIZE:
+                flush()
+                _stream_member(c, zf, zinfo, f.path, f.size)
+                continue
+            data = _read_file(c, f.path, raw=True)
+            pending.append((zinfo, len(data), executor.submit(_compress_member, zinfo.filename, data)))
+            buffered += len(data)
+            flush(ZIP_BUFFER_SIZE)
+        flush()
+
+
+def _previous_manifest(service, directory=None):
+    """Load the most recent manifest of `service` from a snapshot other than `directory`"""
+    for path in sorted(BACKUP_PATH.glob(f"*/{service}.manifest.json"), reverse=True):
+        if path.parent.name != (directory or ""):
+            with open(path, "r") as f:
+                return json.load(f)
+    return {"files": {}}
+
+
+def _store_object(digest):
+    return STORE_PATH / digest[:2] / digest
+
+
+def _fetch_to_store(c, path, bufsize=2**20):
+    """Download remote file into the content-addressed store, return it's sha256"""
+    STORE_PATH.mkdir(parents=True, exist_ok=True)
+    h = hashlib.sha256()
+    with c.sftp().open(path, "rb") as remote, tempfile.NamedTemporaryFile(dir=STORE_PATH, delete=False) as local:
+        remote.prefetch()
+        while chunk := remote.read(bufsize):
+            h.update(chunk)
+            local.write(chunk)
+    tmp = Path(local.name)
+
+    # Only keep the new object if we didn't already have this content
+    obj = _store_object(h.hexdigest())
+    if obj.exists():
+        tmp.unlink()
+    else:
+        obj.parent.mkdir(exist_ok=True)
+        tmp.replace(obj)
+    return h.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    """Hardlink `src` to `dst`, falling back to a copy if the filesystem can't link"""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _incremental_backup(c, root, service, files, directory=None, pbar=lambda x: x):
+    """Only fetch files that changed since the last snapshot. File contents are kept
+    once in `STORE_PATH` and hardlinked into each snapshot, so a snapshot directory is
+    a plain copy of the service's data that can be restored on it's own."""
+    previous = _previous_manifest(service, directory)["files"]
+    manifest = {"root": root, "files": {}}
+    fetched = 0
+
+    for f in pbar(files):
+        rel = Path(f.path).relative_to(root).as_posix()
+        old = previous.get(rel)
+        if old and old["size"] == f.size and old["mtime"] == f.mtime and _store_object(old["sha256"]).exists():
+            digest = old["sha256"]
+        else:
+            digest = _fetch_to_store(c, f.path)
+            fetched += f.size
+        _link_or_copy(_store_object(digest), BACKUP_PATH / (directory or "") / service / rel)
+        manifest["files"][rel] = {"size": f.size, "mtime": f.mtime, "sha256": digest}
+
+    with open(BACKUP_PATH / (directory or "") / f"{service}.manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return fetched
+
+
+def _reuse_backup(service, previous, directory=None):
+    """Hardlink a service's backup (and manifest and listing) from the `previous` snapshot"""
+    for path in previous.glob(f"{service}.*"):
+        _link_or_copy(path, BACKUP_PATH / (directory or "") / path.name)
+    for path in (previous / service).rglob("*"):
+        if path.is_file():
+            _link_or_copy(path, BACKUP_PATH / (directory or "") / path.relative_to(previous))
+
+
+def _streamed_backup(c, root, service, excluded=None, level=3, directory=None, pbar=True, position=None):
+    """Have the remote host tar (and compress) `root` and stream the archive straight
+    to disk, this is a single command and only ever holds one buffer in memory."""
+    excludes = " ".join(shlex.quote(f"--exclude=./{posixpath.relpath(d.rstrip('/'), root)}") for d in excluded or [])
+    tar = f"tar -C {shlex.quote(root)} {excludes} -cf - ."
+    if c.run("command -v zstd", hide=True, warn=True).ok:
+        pipeline, suffix = f"{tar} | zstd -q -c -T0 -{level}", "tar.zst"
+    else:
+        pipeline, suffix = f"{tar} | gzip -c -{min(int(level), 9)}", "tar.gz"
+    # A pipeline's status is the compressor's, fail on tar's too. Except for 1, files that
+    # changed while being read, a live service's data always does and the archive is still usable
+    command = f'{pipeline}; s=("${{PIPESTATUS[@]}}"); [ "${{s[0]}}" -gt 1 ] && exit "${{s[0]}}"; exit "${{s[1]}}"'
+
+    path = BACKUP_PATH / (directory or "") / f"{service}.{suffix}"
+    try:
+        with open(path, "wb") as f:
+            with tqdm(desc=service, unit="B", unit_scale=True, position=position, disable=not pbar) as bar:
+                return _stream_command(c, f"bash -c {shlex.quote(command)}", f, callback=bar.update)
+    except Exception:
+        # Don't leave a truncated archive behind for restore (or the next skip_unchanged) to pick up
+        path.unlink(missing_ok=True)
+        raise
 
 
 def _generic_backup(
@@ -25,51 +244,99 @@ def _generic_backup(
     pbar=True,
     excluded=None,
     compressed=False,
+    incremental=False,
+    archive="zip",
+    level=3,
     verbose=1,
     directory=None,
+    position=None,
+    skip_unchanged=False,
 ):
+    """Download `root` from remote into the backup directory, return number of bytes fetched"""
+    # List the remote tree once, this gives us the total for the progress bar too
+    files = list(_remote_walk(c, root, exclude_dirs=excluded))
+    listing = _listing(files, root, excluded)
+    previous, previous_listing = _previous_listing(service, directory) if skip_unchanged else (None, None)
+    if previous and not any(_diff_listings(previous_listing, listing)):
+        if verbose:
+            print(f"No changes to {service} since {previous.name}, reusing it's backup.")
+        _reuse_backup(service, previous, directory)
+        return 0
+
     if verbose == 1:
         print(f"Downloading {service} backup from {root}...")
-    pbar = partial(tqdm, total=_total_files(c, root)) if pbar and verbose else lambda x: x
-
-    if compressed:
-        with ZipFile(f"{BACKUP_PATH}/{(directory or '') + '/'}{service}.zip", "w") as archive:
-            for path in pbar(_remote_walk(c, root, exclude_dirs=excluded)):
-                if verbose == 2:
-                    print(f"Fetching {path}...")
-                archive.writestr(
-                    ZipInfo(str(Path(path).relative_to(root))),
-                    _read_file(c, path, raw=True),
-                )
 
+    if compressed and archive == "tar" and not incremental:
+        fetched = _streamed_backup(c, root, service, excluded, level, directory, pbar and verbose, position)
+    else:
+        fetched = _fetch_backup(c, root, service, files, pbar, compressed, incremental, verbose, directory, position)
+
+    # Only keep the listing once the backup is complete, the next backup is compared against it
+    with open(BACKUP_PATH / (directory or "") / f"{service}.listing.json", "w") as f:
+        json.dump(listing, f)
+    return fetched
+
+
+def _fetch_backup(c, root, service, files, pbar, compressed, incremental, verbose, directory, position):
+    """Fetch the remote `files` file by file (see `_generic_backup`), return number of bytes fetched"""
+    fetched = sum(f.size for f in files)
+    pbar = partial(tqdm, total=len(files), desc=service, position=position) if pbar and verbose else lambda x: x
+
+    if incremental:
+        fetched = _incremental_backup(c, root, service, files, directory=directory, pbar=pbar)
+        if verbose:
+            print(f"Fetched {fetched} of {sum(f.size for f in files)} bytes for {service}.")
+
+    elif compressed:
+        _zip_backup(c, root, files, BACKUP_PATH / (directory or "") / f"{service}.zip", pbar, verbose)
+
+    else:
+        for f in pbar(files):
+            local = BACKUP_PATH / (directory or "") / service / Path(f.path).relative_to(root)
+            local.parent.mkdir(parents=True, exist_ok=True)
+            c.get(f.path, str(local))
+    return fetched
+
+
+def _arr_urls(host, service, port):
+    """API endpoints used to list, create and restore backups of an *arr service"""
+    if service.lower() == "bazarr":
+        # Bazarr restarts by itself after a restore
+        backups = f"http://{host}:{port}/api/system/backups"
+        return {"list": backups, "create": backups, "restore": backups, "restart": None}
+    base = f"http://{host}:{port}/api/{'v3' if service.lower() in ('radarr', 'sonarr') else 'v1'}"
+    return {
+        "list": f"{base}/system/backup",
+        "create": f"{base}/command",
+        "restore": f"{base}/system/backup/restore/upload",
+        "restart": f"{base}/system/restart",
+    }
+
+
+def _latest_arr_backup(response, max_staleness=48):
+    """Given the response of a list backups call, return the path of the most recent
+    backup or None if there's none more recent than `max_staleness` hours."""
+    # Again, Bazarr plays weird. It's response is not a list but a dict with key data
+    if type(response) is list:
+        if not response:
+            return None
+        timestamp = dateutil.parser.parse(response[0].get("time"))
+        path = response[0]["path"]
     else:
-        for path in pbar(_remote_walk(c, root, exclude_dirs=excluded)):
-            c.get(path, str(BACKUP_PATH / service / Path(path).relative_to(root)))
+        if not response.get("data"):
+            return None
+        timestamp = dateutil.parser.parse(response["data"][-1].get("date")).replace(tzinfo=dateutil.tz.UTC)
+        path = response["data"][-1]["filename"]
+
+    now = datetime.datetime.now(dateutil.tz.UTC)
+    return path if now - timestamp <= datetime.timedelta(hours=max_staleness) else None
 
 
 @task
 def arr_path(c, service, port, apikey, max_staleness=48, sleep=10, retries=3, force=False):
     """Return path of a recent *arr backup, create a new one if needed"""
     # The path returned is a URL path, except for bazarr when it's just a filename...
-    urls = {
-        "default": {
-            "list": f"http://{c.host}:{port}/api/v1/system/backup",
-            "create": f"http://{c.host}:{port}/api/v1/command",
-        },
-        "radarr": {
-            "list": f"http://{c.host}:{port}/api/v3/system/backup",
-            "create": f"http://{c.host}:{port}/api/v3/command",
-        },
-        "sonarr": {
-            "list": f"http://{c.host}:{port}/api/v3/system/backup",
-            "create": f"http://{c.host}:{port}/api/v3/command",
-        },
-        "bazarr": {
-            "list": f"http://{c.host}:{port}/api/system/backups",
-            "create": f"http://{c.host}:{port}/api/system/backups",
-        },
-    }
-    urls = urls.get(service.lower(), urls["default"])
+    urls = _arr_urls(c.host, service, port)
 
     def list_backups():
         """Call *arr API, get list of backups (most recent first)"""
@@ -87,32 +354,12 @@ def arr_path(c, service, port, apikey, max_staleness=48, sleep=10, retries=3, fo
     if retries <= 0:
         raise RuntimeError("Cannot create or find suitable backup!")
 
-    if (response := list_backups()) and not force:
-        # Again, Bazarr plays weird. It's response is not a list but a dict with key data
-        if type(response) is list:
-            stale = False
-            timestamp = response[0].get("time")
-            timestamp = dateutil.parser.parse(timestamp)
-        else:
-            if response["data"]:
-                stale = False
-                timestamp = response["data"][-1].get("date")
-                timestamp = dateutil.parser.parse(timestamp).replace(tzinfo=dateutil.tz.UTC)
-            else:
-                stale = True
-                timestamp = datetime.datetime(1970, 1, 1, 0, 0, tzinfo=dateutil.tz.UTC)
-
-        now = datetime.datetime.now(dateutil.tz.UTC)
-        if stale or now - timestamp > datetime.timedelta(hours=max_staleness):
-            # If they are all stale, create one
-            create_backup()
-            time.sleep(sleep)
-        else:
-            return response[0]["path"] if type(response) is list else response["data"][-1]["filename"]
-    else:
-        # If none exist, create one
-        create_backup()
-        time.sleep(sleep)
+    if not force and (path := _latest_arr_backup(list_backups(), max_staleness)):
+        return path
+
+    # If none exist or they are all stale, create one
+    create_backup()
+    time.sleep(sleep)
     return arr_path(
         c,
         service,
@@ -125,64 +372,147 @@ def arr_path(c, service, port, apikey, max_staleness=48, sleep=10, retries=3, fo
     )
 
 
+async def _arr_backup(host, service, port, apikey, max_staleness=48, force=False, timeout=600):
+    """Same as `arr_path` but polls the API with a backoff until the backup is done
+    instead of sleeping a fixed amount, so that many services can be awaited at once."""
+    urls = _arr_urls(host, service, port)
+
+    async def call(method, url, **kwargs):
+        response = await asyncio.to_thread(method, url, headers={"X-Api-Key": apikey}, timeout=30, **kwargs)
+        response.raise_for_status()
+        return response.json() if response.content else {}  # bazaar again...
+
+    previous = _latest_arr_backup(await call(requests.get, urls["list"]), max_staleness)
+    if previous and not force:
+        return previous
+
+    print(f"Creating backup for {service}...")
+    command = await call(requests.post, urls["create"], json={"name": "Backup"})
+    deadline, delay = time.monotonic() + timeout, 0.5
+
+    while time.monotonic() < deadline:
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 15)
+        if "id" in command:
+            # Regular *arrs give us a command we can check the status of
+            command = await call(requests.get, f"{urls['create']}/{command['id']}")
+            if command.get("status") == "failed":
+                raise RuntimeError(f"Backup of {service} failed: {command.get('message')}")
+            if command.get("status") != "completed":
+                continue
+        # Bazarr doesn't, so we wait for a new backup to be listed
+        if (path := _latest_arr_backup(await call(requests.get, urls["list"]), max_staleness)) and path != previous:
+            return path
+    raise RuntimeError(f"Timed out waiting for {service} to create a backup!")
+
+
+async def _arr_backups(c, running_arrs, download, max_staleness=48, force=False, timeout=600):
+    """Trigger backups of all *arrs at once, call `download(service, path)` on each as soon as
+    it's ready. Downloads share `c`'s sftp client so they are done one at a time."""
+    lock = asyncio.Lock()
+
+    async def backup(service, apikey, port):
+        path = await _arr_backup(c.host, service, port, apikey, max_staleness, force=force, timeout=timeout)
+        async with lock:
+            return await asyncio.to_thread(download, service, path)
+
+    results = await asyncio.gather(
+        *(backup(service, apikey, port) for service, (apikey, port) in running_arrs.items()),
+        return_exceptions=True,
+    )
+    for service, result in zip(running_arrs, results):
+        if isinstance(result, Exception):
+            print(f"WARNING: Could not backup {service}: {result}")
+    return sum(result for result in results if not isinstance(result, Exception))
+
+
+def _arr_remote_path(service, path):
+    """Where the backup at API path `path` lives on the host, given the service's /config is
+    mounted at `SERVICES_REMOTE_ROOT/<service>`: `/backup/<type>/<name>` is `Backups/<type>/<name>`
+    and Bazarr only gives a filename, found in `backup/`"""
+    if service.lower() == "bazarr":
+        return f"{SERVICES_REMOTE_ROOT}/{service}/backup/{Path(path).name}"
+    return f"{SERVICES_REMOTE_ROOT}/{service}/Backups/{posixpath.relpath(path, '/backup')}"
+
+
+def _download_arr_backup(c, service, port, apikey, path, local, bufsize=2**20):
+    """Download the *arr backup at API path `path` to `local`, over HTTP if the service serves
+    it, otherwise from it's exact location on the host. Returns the number of bytes fetched."""
+    local = Path(local)
+    url = f"http://{c.host}:{port}{path}"
+    print(f"Downloading {service} backup from {url if service.lower() != 'bazarr' else path}...")
+
+    if service.lower() != "bazarr":
+        part = Path(f"{local}.part")
+        try:
+            # Redirects aren't followed, with forms auth they lead to the login page which is served with a 200
+            with requests.get(
+                url, headers={"X-Api-Key": apikey}, stream=True, timeout=30, allow_redirects=False
+            ) as response:
+                if response.status_code != 200:
+                    raise IOError(f"HTTP {response.status_code}")
+                size = 0
+                with open(part, "wb") as f:
+                    for chunk in response.iter_content(bufsize):
+                        f.write(chunk)
+                        size += len(chunk)
+                if (expected := response.headers.get("Content-Length")) and int(expected) != size:
+                    raise IOError(f"downloaded {size} bytes but expected {expected}")
+            with ZipFile(part) as zf:
+                if (bad := zf.testzip()) is not None:
+                    raise IOError(f"bad CRC for {bad}")
+            part.replace(local)
+            return size
+        except (IOError, BadZipFile) as e:
+            part.unlink(missing_ok=True)
+            print(f"Could not download {service}'s backup over HTTP ({e}), fetching it from the host instead.")
+
+    # Fallback to fetching the exact file from the host, and compare checksums
+    remote = _arr_remote_path(service, path)
+    size = _resumable_get(c, remote, local)
+    expected = c.run(f"sha256sum {shlex.quote(remote)}", hide=True).stdout.split()[0]
+    if _file_sha256(local) != expected:
+        raise IOError(f"Checksum mismatch for {service}'s backup!")
+    return size
+
+
 @task
 def arrs(
     c,
     services_config=None,
     root=None,
     max_staleness=48,
-    retries=3,
-    sleep=10,
+    timeout=600,
     force=False,
     directory=None,
+    **kwargs,
 ):
     """Copy remote *arr backup directories to `backup/`"""
-    services = _load_service_config(services_config, root)
+    # Get api keys and ports, along with which services are running, in one round trip
+    snap = status.snapshot(c, services_config=services_config, root=root, verbose=False)
+    running_arrs = {service for service in snap["arrs"] if snap["services"].get(service)}
 
-    # Get api keys and ports
-    arrs = set(service for service in services if service.lower().endswith("arr"))
-    running_arrs = set(
-        service for service in status.dcp_running_services(c, verbose=False) if service.lower().endswith("arr")
-    )
-
-    if missing_arrs := arrs - running_arrs:
+    if missing_arrs := snap["arrs"].keys() - running_arrs:
         print(f"WARNING: Skipping {', '.join(missing_arrs)} as they are not running!")
 
     running_arrs = {
-        service: (
-            status.get_arrkey(c, service),
-            status.get_arrport(c, service),
-        )
+        service: (snap["arrs"][service].get("ApiKey") or "", snap["arrs"][service].get("Port") or "")
         for service in running_arrs
     }
 
-    for service, (apikey, port) in running_arrs.items():
-        backup = Path(
-            arr_path(
-                c,
-                service,
-                port,
-                apikey,
-                max_staleness=max_staleness,
-                sleep=sleep,
-                retries=retries,
-                force=force,
-            )
-        ).name
+    def download(service, path):
+        apikey, port = running_arrs[service]
+        return _download_arr_backup(c, service, port, apikey, path, BACKUP_PATH / (directory or "") / Path(path).name)
 
-        for path in _remote_walk(c, f"{SERVICES_REMOTE_ROOT}/{service}"):
-            if path.endswith(backup):
-                print(f"Downloading {service} backup from {path}...")
-                c.get(path, str(BACKUP_PATH / (directory or "") / backup))
-                break
-        else:
-            print(f"No backup found for {service}!!")
+    return asyncio.run(
+        _arr_backups(c, running_arrs, download, max_staleness=max_staleness, force=force, timeout=timeout)
+    )
 
 
 @task
 def code_server(c, directory=None, **kwargs):
     """Make a backup of code-server data"""
-    _generic_backup(
+    return _generic_backup(
         c,
         f"{SERVICES_REMOTE_ROOT}/code-server",
         "code-server",
@@ -195,7 +525,7 @@ def code_server(c, directory=None, **kwargs):
 @task
 def gluetun(c, directory=None, **kwargs):
     """Make a backup of gluetun data"""
-    _generic_backup(
+    return _generic_backup(
         c,
         f"{SERVICES_REMOTE_ROOT}/gluetun",
         "gluetun",
@@ -208,7 +538,7 @@ def gluetun(c, directory=None, **kwargs):
 @task
 def homer(c, directory=None, **kwargs):
     """Make a backup of homer data"""
-    _generic_backup(
+    return _generic_backup(
         c,
         f"{SERVICES_REMOTE_ROOT}/homer",
         "homer",
@@ -221,7 +551,7 @@ def homer(c, directory=None, **kwargs):
 @task
 def ombi(c, directory=None, **kwargs):
     """Make a backup of ombi data"""
-    _generic_backup(
+    return _generic_backup(
         c,
         f"{SERVICES_REMOTE_ROOT}/ombi",
         "ombi",
@@ -243,12 +573,13 @@ def pihole(c, directory=None, **kwargs):
     path = Path(path) / c.run(f"ls {path}", hide=True).stdout.strip()
     print(f"Downloading pihole backup from {path.as_posix()}...")
     c.get(path.as_posix(), (BACKUP_PATH / (directory or "") / path.name).as_posix())
+    return os.path.getsize(BACKUP_PATH / (directory or "") / path.name)
 
 
 @task
 def plex(c, directory=None, **kwargs):
     """Make a backup of plex data while skipping cache data"""
-    _generic_backup(
+    return _generic_backup(
         c,
         f"{SERVICES_REMOTE_ROOT}/plex",
         "plex",
@@ -262,7 +593,7 @@ def plex(c, directory=None, **kwargs):
 @task
 def tautulli(c, directory=None, **kwargs):
     """Make a backup of tautulli data"""
-    _generic_backup(
+    return _generic_backup(
         c,
         f"{SERVICES_REMOTE_ROOT}/tautulli",
         "tautulli",
@@ -275,7 +606,7 @@ def tautulli(c, directory=None, **kwargs):
 @task
 def transmission(c, directory=None, **kwargs):
     """Make a backup of transmission data"""
-    _generic_backup(
+    return _generic_backup(
         c,
         f"{SERVICES_REMOTE_ROOT}/transmission",
         "transmission",
@@ -288,7 +619,7 @@ def transmission(c, directory=None, **kwargs):
 @task
 def wgeasy(c, directory=None, **kwargs):
     """Make a backup of wgeasy data"""
-    _generic_backup(
+    return _generic_backup(
         c,
         f"{SERVICES_REMOTE_ROOT}/wgeasy",
         "wgeasy",
@@ -301,7 +632,7 @@ def wgeasy(c, directory=None, **kwargs):
 @task
 def wireguard(c, directory=None, **kwargs):
     """Make a backup of wireguard data"""
-    _generic_backup(
+    return _generic_backup(
         c,
         f"{SERVICES_REMOTE_ROOT}/wireguard",
         "wireguard",
@@ -311,8 +642,70 @@ def wireguard(c, directory=None, **kwargs):
     )
 
 
-@task(aliases=["backup"], default=True)
-def all(c, services_config=None, root=None, force=False):
+def _backup_jobs(services_config=None, root=None, force=False):
+    """List of (name, subtask) for every backup subtask, longest running first"""
+    return [
+        ("plex", plex),
+        ("arrs", partial(arrs, services_config=services_config, root=root, force=force)),
+        ("code-server", code_server),
+        ("gluetun", gluetun),
+        ("homer", homer),
+        ("ombi", ombi),
+        ("pihole", partial(pihole, verbose=2)),
+        ("tautulli", tautulli),
+        ("transmission", transmission),
+        ("wgeasy", wgeasy),
+        ("wireguard", wireguard),
+    ]
+
+
+def _run_jobs(c, jobs, max_workers=4, **kwargs):
+    """Run backup (or restore) subtasks concurrently, each on one of `max_workers` connections to
+    the host. Returns a dict of name -> (bytes moved, seconds taken)."""
+    pool = queue.Queue()
+    pool.put(c)
+    for _ in range(min(max_workers, len(jobs)) - 1):
+        pool.put(_clone_connection(c))
+
+    def run(position, job):
+        conn = pool.get()
+        try:
+            start = time.time()
+            return job(conn, position=position, **kwargs) or 0, time.time() - start
+        finally:
+            pool.put(conn)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {name: executor.submit(run, i, job) for i, (name, job) in enumerate(jobs)}
+            return {name: future.result() for name, future in futures.items()}
+    finally:
+        while not pool.empty():
+            if (conn := pool.get()) is not c:
+                conn.close()
+
+
+@task(
+    aliases=["backup"],
+    default=True,
+    help={
+        "jobs": "Number of services to back up concurrently",
+        "archive": "Either `zip` (fetched file by file) or `tar` (streamed from host)",
+        "level": "Compression level used by `tar` archives",
+        "skip_unchanged": "Reuse the previous backup of services whose files did not change",
+    },
+)
+def all(
+    c,
+    services_config=None,
+    root=None,
+    force=False,
+    incremental=False,
+    jobs=4,
+    archive="zip",
+    level=3,
+    skip_unchanged=False,
+):
     """Run all backup subtasks"""
     # Call dependencies, this should be done via pre-tasks
     # but theres a bug on windows (https://github.com/fabric/fabric/issues/2202)
@@ -320,31 +713,494 @@ def all(c, services_config=None, root=None, force=False):
     os.makedirs(BACKUP_PATH / directory, exist_ok=True)
     print(f"Writing backup to {BACKUP_PATH / directory}.")
 
-    arrs(c, services_config, root, force=force, directory=directory)
-    code_server(c, directory=directory)
-    gluetun(c, directory=directory)
-    homer(c, directory=directory)
-    ombi(c, directory=directory)
-    pihole(c, directory=directory, verbose=2)
-    plex(c, directory=directory)
-    tautulli(c, directory=directory)
-    transmission(c, directory=directory)
-    wgeasy(c, directory=directory)
-    wireguard(c, directory=directory)
+    start = time.time()
+    summary = _run_jobs(
+        c,
+        _backup_jobs(services_config, root, force=force),
+        max_workers=int(jobs),
+        directory=directory,
+        incremental=incremental,
+        archive=archive,
+        level=int(level),
+        skip_unchanged=skip_unchanged,
+    )
 
+    print(f"Backup done in {humanize.naturaldelta(time.time() - start)}:")
+    for name, (fetched, elapsed) in summary.items():
+        print(f"  {name:<15}{humanize.naturalsize(fetched):>12}{elapsed:>10.1f}s")
 
-@task
-def restore_simple(c, name, overwrite=True, services_config=None, root=None):
-    """Upload and unzip all not arr backups"""
-    for service in _load_service_config(services_config, root):
+    print("Indexing backup...")
+    _index_snapshot(BACKUP_PATH / directory)
+
+
+class _HashingReader:
+    """File wrapper which hashes everything read through it"""
+
+    def __init__(self, f):
+        self.f, self.sha256 = f, hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def _tar_from_zip(path, write):
+    """Convert a zip archive to an (uncompressed) tar stream, member by member. Zipfile
+    checks each member's CRC as it's read, so a corrupted archive raises midway."""
+    with ZipFile(path) as zf, tarfile.open(fileobj=SimpleNamespace(write=write), mode="w|") as tar:
+        for info in zf.infolist():
+            member = tarfile.TarInfo(info.filename.rstrip("/"))
+            member.mtime = time.mktime(info.date_time + (0, 0, -1))
+            member.mode = (info.external_attr >> 16) & 0o7777 or (0o755 if info.is_dir() else 0o644)
+            if info.is_dir():
+                member.type = tarfile.DIRTYPE
+                tar.addfile(member)
+            else:
+                member.size = info.file_size
+                with zf.open(info) as f:
+                    tar.addfile(member, f)
+
+
+def _tar_from_snapshot(directory, manifest, write):
+    """Tar the files of an incremental snapshot, checking their content against the manifest"""
+    with tarfile.open(fileobj=SimpleNamespace(write=write), mode="w|") as tar:
+        for rel, meta in manifest["files"].items():
+            member = tar.gettarinfo(directory / rel, arcname=rel)
+            member.mtime = meta["mtime"]
+            with open(directory / rel, "rb") as f:
+                tar.addfile(member, reader := _HashingReader(f))
+            if reader.sha256.hexdigest() != meta["sha256"]:
+                raise IOError(f"Checksum mismatch for {directory / rel}, snapshot is corrupted!")
+
+
+def _restore_service(c, service, path, overwrite=True, pbar=True, position=None, root=SERVICES_REMOTE_ROOT, sudo=True):
+    """Stream one service's archive (or incremental snapshot) into a `tar -x` on the host,
+    nothing is written to the host's disk but the extracted files. Returns bytes sent."""
+    destination = shlex.quote(f"{root}/{service}")
+    if path.is_dir():
+        with open(path.parent / f"{service}.manifest.json", "r") as f:
+            produce, flags = partial(_tar_from_snapshot, path, json.load(f)), ""
+    elif path.suffix == ".zip":
+        produce, flags = partial(_tar_from_zip, path), ""
+    else:
+        flags = "--zstd" if path.suffix == ".zst" else "-z"
+
+        def produce(write):
+            with open(path, "rb") as f:
+                while chunk := f.read(2**20):
+                    write(chunk)
+
+    # Checksums are only verified as the archive streams, so extract next to the service's data and only
+    # replace it once everything made it through
+    staging = shlex.quote(f"{root}/{service}.restore")
+    run = partial(c.sudo if sudo else c.run, hide=True)
+    script = f"rm -rf {staging} && mkdir -p {staging} && tar -x {flags} -C {staging}"
+    with tqdm(desc=service, unit="B", unit_scale=True, position=position, disable=not pbar) as bar:
+
+        def write(write_, data):
+            write_(data)
+            bar.update(len(data))
+
+        try:
+            sent = _feed_command(c, f"sh -c {shlex.quote(script)}", lambda w: produce(partial(write, w)), sudo=sudo)
+        except Exception:
+            run(f"rm -rf {staging}", warn=True)
+            raise
+
+    if overwrite:
+        run(f"rm -rf {destination} && mv {staging} {destination}")
+    else:
+        run(f"mkdir -p {destination} && cp -a {staging}/. {destination}/ && rm -rf {staging}")
+    return sent
+
+
+def _restore_arr(c, service, port, apikey, path, **kwargs):
+    """Upload an *arr backup through it's API and restart it. Returns bytes sent."""
+    if (bad := ZipFile(path).testzip()) is not None:
+        raise IOError(f"Backup of {service} is corrupted, bad CRC for {bad}!")
+    urls, headers = _arr_urls(c.host, service, port), {"X-Api-Key": apikey}
+    print(f"Restoring {service} from {path.name}...")
+    if service.lower() == "bazarr":
+        # Bazarr can only restore backups found in it's own backup directory
+        _resumable_put(c, path, _arr_remote_path(service, path.name))
+        response = requests.patch(urls["restore"], headers=headers, data={"filename": path.name}, timeout=600)
+    else:
+        with open(path, "rb") as f:
+            files = {"restore": (path.name, f, "application/zip")}
+            response = requests.post(urls["restore"], headers=headers, files=files, timeout=600)
+    response.raise_for_status()
+    if urls["restart"] and (response.json() if response.content else {}).get("RestartRequired"):
+        requests.post(urls["restart"], headers=headers, timeout=30).raise_for_status()
+    return path.stat().st_size
+
+
+def _restore_jobs(c, name, services, overwrite=True, services_config=None, root=None):
+    """List restore subtasks, as (name, job) pairs, for everything found in backup `name`"""
+    jobs, snapshot, arr_jobs = [], BACKUP_PATH / name, {}
+    for service in services:
         service_safe = service.replace("_", "-")
-        if not glob.glob(str(BACKUP_PATH / name / f"{service_safe}*.zip")):
+        if service.lower().endswith("arr"):
+            if archives := sorted(snapshot.glob(f"{service.lower()}_backup*.zip")):
+                arr_jobs[service] = archives[-1]
             continue
-        if not service.lower().endswith("arr"):
-            archive = f"{service_safe}.zip"
-            print(f"Restoring {service}...")
-            c.put(str(BACKUP_PATH / name / archive))
-            if overwrite:
-                c.sudo(f"rm -rf /srv/{service_safe}", hide=True)
-            c.sudo(f"unzip -q ~/{archive} -d /srv/{service_safe}", hide=True)
-            c.run(f"rm {archive}", hide=True)
+        for path in (snapshot / service_safe, *(snapshot / f"{service_safe}.{ext}" for ext in _ARCHIVE_FORMATS)):
+            if path.is_dir() and (snapshot / f"{service_safe}.manifest.json").exists() or path.is_file():
+                jobs.append(
+                    (service_safe, partial(_restore_service, service=service_safe, path=path, overwrite=overwrite))
+                )
+                break
+
+    if arr_jobs:
+        # Fresh *arrs have new api keys, look them up along with which ones are up
+        snap = status.snapshot(c, services_config=services_config, root=root, verbose=False)
+        for service, path in arr_jobs.items():
+            if not snap["services"].get(service):
+                print(f"WARNING: Skipping {service} as it is not running!")
+                continue
+            conf = snap["arrs"][service]
+            jobs.append(
+                (service, partial(_restore_arr, service=service, port=conf["Port"], apikey=conf["ApiKey"], path=path))
+            )
+    return jobs
+
+
+@task(help={"jobs": "Number of services to restore concurrently", "overwrite": "Remove existing data first"})
+def restore_simple(c, name, overwrite=True, services_config=None, root=None, jobs=4):
+    """Restore all services from backup `name`, streaming archives straight into the host"""
+    start = time.time()
+    services = _load_service_config(services_config, root)
+    summary = _run_jobs(
+        c,
+        _restore_jobs(c, name, services, overwrite=overwrite, services_config=services_config, root=root),
+        max_workers=int(jobs),
+    )
+
+    print(f"Restore done in {humanize.naturaldelta(time.time() - start)}:")
+    for service, (sent, elapsed) in summary.items():
+        print(f"  {service:<15}{humanize.naturalsize(sent):>12}{elapsed:>10.1f}s")
+
+
+def _snapshot_path(name=None):
+    """Path of backup `name`, or of the most recent one"""
+    if name:
+        return BACKUP_PATH / name
+    if not (snapshots := sorted(p for p in BACKUP_PATH.glob("*") if p.is_dir() and p.name != STORE_DIR)):
+        raise FileNotFoundError(f"No backups found in {BACKUP_PATH}!")
+    return snapshots[-1]
+
+
+def _archive_format(path):
+    """Either `zip`, `tar` or `dir` (incremental or uncompressed backups), None if it's not an archive"""
+    if path.is_dir():
+        return "dir"
+    if path.name.endswith(".zip"):
+        return "zip"
+    if path.name.endswith((".tar", ".tar.gz", ".tar.zst")):
+        return "tar"
+    return None
+
+
+@contextlib.contextmanager
+def _open_tar(path):
+    """Open a (possibly compressed) tar archive for sequential reading"""
+    if path.suffix != ".zst":
+        with tarfile.open(path, "r|*") as tar:
+            yield tar
+        return
+    proc = subprocess.Popen(["zstd", "-dcq", str(path)], stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+            yield tar
+    finally:
+        # We might stop reading early, i.e: when extracting a single file
+        proc.kill()
+        proc.wait()
+
+
+def _list_members(path):
+    """Names of the files in an archive, None for tars which can only be read sequentially"""
+    if (fmt := _archive_format(path)) == "zip":
+        with ZipFile(path) as zf:
+            return [info.filename for info in zf.infolist() if not info.is_dir()]
+    if fmt == "dir":
+        return sorted(p.relative_to(path).as_posix() for p in path.rglob("*") if p.is_file())
+    return None
+
+
+def _iter_members(path, names=None):
+    """Yield (name, size, mtime, file object) for the files of an archive, or only those in `names`.
+    Zips and directories are read at random, tars sequentially up to the last file in `names`."""
+    fmt = _archive_format(path)
+    if fmt == "zip":
+        with ZipFile(path) as zf:
+            for info in zf.infolist() if names is None else map(zf.getinfo, names):
+                if not info.is_dir():
+                    with zf.open(info) as f:
+                        yield info.filename, info.file_size, time.mktime(info.date_time + (0, 0, -1)), f
+    elif fmt == "tar":
+        remaining = None if names is None else set(names)
+        with _open_tar(path) as tar:
+            for member in tar:
+                name = posixpath.normpath(member.name)
+                if member.isfile() and (remaining is None or name in remaining):
+                    yield name, member.size, member.mtime, tar.extractfile(member)
+                    if remaining is not None and not (remaining := remaining - {name}):
+                        return
+    else:
+        for name in _list_members(path) if names is None else names:
+            with open(path / name, "rb") as f:
+                yield name, os.fstat(f.fileno()).st_size, os.fstat(f.fileno()).st_mtime, f
+
+
+def _hash_members(path, names=None):
+    """Return {name: {size, mtime, sha256}} for the files of an archive (see `_iter_members`)"""
+    return {
+        name: {"size": size, "mtime": mtime, "sha256": _file_sha256(f)}
+        for name, size, mtime, f in _iter_members(path, names)
+    }
+
+
+def _verify_members(path, expected):
+    """Hash the files of an archive listed in `expected` (as found in the index), return a list of problems"""
+    try:
+        if (fmt := _archive_format(path)) == "zip":
+            names = [name for name in _list_members(path) if name in expected]
+        else:
+            names = None if fmt == "tar" else [name for name in expected if (path / name).is_file()]
+        actual = _hash_members(path, names)
+    except (OSError, KeyError, EOFError, BadZipFile, tarfile.TarError) as e:
+        return [f"{path.name}: cannot be read ({e})"]
+    return [
+        f"{path.name}: {name} is {'missing' if name not in actual else 'corrupted'}"
+        for name, meta in expected.items()
+        if actual.get(name, {}).get("sha256") != meta["sha256"]
+    ]
+
+
+def _batches(path, members, batch=256):
+    """Split the files of an archive in batches to be read in parallel, tars are read in one go"""
+    if _archive_format(path) == "tar":
+        return [None]
+    members = list(members)
+    return [members[i : i + batch] for i in range(0, len(members), batch)]
+
+
+def _index_snapshot(snapshot, workers=None):
+    """Write an index of every file (path, size, mtime and sha256) of every archive of a backup,
+    archives are hashed in parallel. Incremental snapshots reuse their manifest."""
+    index, archives = {}, {}
+    for path in sorted(snapshot.glob("*")):
+        if (fmt := _archive_format(path)) == "dir" and (manifest := snapshot / f"{path.name}.manifest.json").exists():
+            with open(manifest, "r") as f:
+                index[path.name] = {"format": fmt, "members": json.load(f)["files"]}
+        elif fmt:
+            archives[path.name] = path
+            index[path.name] = {"format": fmt, "members": {}}
+
+    # Threads rather than processes, the task's ssh and progress bar threads make forking unsafe. Hashing and
+    # decompressing release the GIL so they still run on all cores
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        futures = {
+            executor.submit(_hash_members, path, names): name
+            for name, path in archives.items()
+            for names in _batches(path, _list_members(path) or [])
+        }
+        for future in as_completed(futures):
+            index[futures[future]]["members"].update(future.result())
+
+    with open(snapshot / INDEX_FILE, "w") as f:
+        json.dump({"archives": index}, f, indent=2, sort_keys=True)
+    return index
+
+
+def _load_index(snapshot, workers=None):
+    try:
+        with open(snapshot / INDEX_FILE, "r") as f:
+            return json.load(f)["archives"]
+    except FileNotFoundError:
+        print(f"No index found for {snapshot.name}, creating one...")
+        return _index_snapshot(snapshot, workers)
+
+
+@task(help={"name": "Backup to check (default: most recent)", "workers": "Number of threads (default: one per core)"})
+def verify(_, name=None, workers=None):
+    """Check every file of a backup against it's index, in parallel"""
+    snapshot, workers = _snapshot_path(name), workers and int(workers)
+    index, start, problems = _load_index(snapshot, workers), time.time(), []
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        futures = []
+        for archive, entry in index.items():
+            if not (path := snapshot / archive).exists():
+                problems.append(f"{archive}: is missing")
+                continue
+            for names in _batches(path, members := entry["members"]):
+                subset = members if names is None else {member: members[member] for member in names}
+                futures.append(executor.submit(_verify_members, path, subset))
+        for future in as_completed(futures):
+            problems.extend(future.result())
+
+    if problems:
+        print("\n".join(sorted(problems)))
+    files = sum(len(entry["members"]) for entry in index.values())
+    print(
+        f"Checked {files} files from {len(index)} archives in {humanize.naturaldelta(time.time() - start)}, "
+        f"{len(problems) or 'no'} problem(s) found."
+    )
+    return problems
+
+
+@task(help={"pattern": "Only list files matching this glob, i.e: `*library.db`", "archive": "Glob of archives to list"})
+def ls(_, pattern="*", archive="*", name=None):
+    """List the files of a backup (default: most recent) from it's index"""
+    index, found = _load_index(_snapshot_path(name)), []
+    for archive_name, entry in sorted(index.items()):
+        if fnmatch(archive_name, archive):
+            for member, meta in sorted(entry["members"].items()):
+                if fnmatch(member, pattern):
+                    mtime = datetime.datetime.fromtimestamp(meta["mtime"])
+                    print(f"{humanize.naturalsize(meta['size']):>10}  {mtime:%Y-%m-%d %H:%M}  {archive_name}/{member}")
+                    found.append((archive_name, member))
+    return found
+
+
+@task(help={"pattern": "Glob of files to extract", "archive": "Glob of archives to extract from"})
+def extract(_, pattern, archive="*", name=None, output="."):
+    """Extract some files of a backup (default: most recent) without reading whole archives"""
+    snapshot, extracted = _snapshot_path(name), []
+    for archive_name, entry in sorted(_load_index(snapshot).items()):
+        members = entry["members"]
+        if not fnmatch(archive_name, archive) or not (names := [m for m in members if fnmatch(m, pattern)]):
+            continue
+        root = (Path(output) / archive_name.split(".")[0]).resolve()
+        for member, _size, mtime, f in _iter_members(snapshot / archive_name, names):
+            if not (path := (root / member).resolve()).is_relative_to(root):
+                raise ValueError(f"Refusing to extract {member} outside of {root}!")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "wb") as out:
+                shutil.copyfileobj(reader := _HashingReader(f), out)
+            os.utime(path, (mtime, mtime))
+            if reader.sha256.hexdigest() != members[member]["sha256"]:
+                raise IOError(f"Checksum mismatch for {archive_name}/{member}, backup is corrupted!")
+            print(f"Extracted {archive_name}/{member} to {path}")
+            extracted.append(path)
+    if not extracted:
+        print(f"No files matching {pattern} found!")
+    return extracted
+
+
+def _snapshots():
+    """List backups as (datetime, path), most recent first, skipping directories not named by `backup.all`"""
+    snapshots = []
+    for path in BACKUP_PATH.glob("*"):
+        try:
+            snapshots.append((datetime.datetime.strptime(path.name, "%Y-%m-%d--%H-%M-%S"), path))
+        except ValueError:
+            continue
+    return sorted(snapshots, reverse=True)
+
+
+def _retained(snapshots, daily=7, weekly=4, monthly=6):
+    """Return {name: [rules]} of the backups kept by a retention policy. Each rule keeps the
+    most recent backup of each of it's last N days, weeks or months. The latest is always kept."""
+    rules = {
+        "daily": (daily, lambda when: when.date()),
+        "weekly": (weekly, lambda when: when.isocalendar()[:2]),
+        "monthly": (monthly, lambda when: (when.year, when.month)),
+    }
+    keep = defaultdict(list)
+    if snapshots:
+        keep[snapshots[0][1].name].append("latest")
+    for rule, (count, period) in rules.items():
+        periods = set()
+        for when, path in snapshots:
+            if len(periods) >= int(count):
+                break
+            if period(when) not in periods:
+                periods.add(period(when))
+                keep[path.name].append(rule)
+    return keep
+
+
+def _snapshot_usage(path):
+    """Return ({(st_dev, st_ino): size} of archives, {sha256: size} of store objects) used by a backup.
+    Archives are keyed by inode as reused ones are hardlinks to the previous backup's. Incremental
+    snapshots are hardlinks to the store so their manifest is used instead of walking them."""
+    archives, objects = {}, {}
+
+    def add(file):
+        # Not DirEntry.stat, which leaves st_ino to 0 on windows
+        st = file.stat()
+        archives[st.st_dev, st.st_ino] = st.st_size
+
+    for entry in os.scandir(path):
+        if entry.name.endswith(".manifest.json"):
+            with open(entry.path, "r") as f:
+                objects.update((meta["sha256"], meta["size"]) for meta in json.load(f)["files"].values())
+        elif entry.is_file():
+            add(Path(entry.path))
+        elif not (path / f"{entry.name}.manifest.json").exists():
+            # Uncompressed backups are plain directories
+            for file in Path(entry.path).rglob("*"):
+                if file.is_file():
+                    add(file)
+    return archives, objects
+
+
+@task(
+    help={
+        "daily": "Number of days to keep the latest backup of",
+        "weekly": "Number of weeks to keep the latest backup of",
+        "monthly": "Number of months to keep the latest backup of",
+        "max_gb": "Also drop the oldest backups until the rest fit in this many GB",
+        "dry_run": "Only show what would be deleted and the space it would free",
+    }
+)
+def prune(_, daily=7, weekly=4, monthly=6, max_gb=None, dry_run=False):
+    """Delete backups not kept by the retention policy, and store objects no kept backup uses"""
+    snapshots = _snapshots()
+    keep = _retained(snapshots, daily, weekly, monthly)
+    usage = {path.name: _snapshot_usage(path) for _, path in snapshots}
+
+    def total(names):
+        archives = {inode: size for name in names for inode, size in usage[name][0].items()}
+        objects = {digest: size for name in names for digest, size in usage[name][1].items()}
+        return sum(archives.values()) + sum(objects.values())
+
+    # Keep dropping the oldest backup over the cap, but never the latest
+    capped = set()
+    while max_gb and len(keep) > 1 and total(keep) > float(max_gb) * 10**9:
+        capped.add(oldest := next(path.name for _, path in reversed(snapshots) if path.name in keep))
+        del keep[oldest]
+
+    # Store objects are freed once no backup links to them, that is those only used by pruned backups
+    # and those (left over by an interrupted backup for instance) which only the store links to
+    pruned = [path for _, path in snapshots if path.name not in keep]
+    used = {digest for name in keep for digest in usage[name][1]}
+    dropped = {digest for path in pruned for digest in usage[path.name][1]} - used
+    garbage = [
+        obj for obj in STORE_PATH.glob("*/*") if obj.name in dropped or obj.stat().st_nlink == 1 and obj.name not in used
+    ]
+    # Likewise archives are only freed once no kept backup links to them
+    kept_archives = {inode for name in keep for inode in usage[name][0]}
+    archives = {inode: size for path in pruned for inode, size in usage[path.name][0].items()}
+    freed = sum(size for inode, size in archives.items() if inode not in kept_archives)
+    freed += sum(obj.stat().st_size for obj in garbage)
+
+    for _, path in snapshots:
+        status = f"keep ({', '.join(keep[path.name])})" if path.name in keep else "prune"
+        status += " (over size cap)" if path.name in capped else ""
+        print(f"  {path.name:<24}{status:<36}{humanize.naturalsize(total([path.name])):>12}")
+    print(
+        f"{'Would free' if dry_run else 'Freeing'} {humanize.naturalsize(freed)} "
+        f"({len(pruned)} backups, {len(garbage)} store objects)."
+    )
+    if not dry_run:
+        for path in pruned:
+            shutil.rmtree(path)
+        for obj in garbage:
+            # Snapshots without a manifest (but with links to the store) keep their objects
+            if obj.stat().st_nlink == 1:
+                obj.unlink()
+    return freed
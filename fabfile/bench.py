@@ -0,0 +1,321 @@
+import contextlib
+import datetime
+import getpass
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+import paramiko
+from fabric import Connection
+from invoke.exceptions import Exit
+
+from fabfile import backup, utils
+from fabfile.defaults import BENCH_PATH
+from fabfile.utils import (
+    _get_service_compose,
+    _load_service_config,
+    _read_file,
+    _remote_walk,
+    task,
+)
+
+# Synthetic service trees as [(subdirectory, share of the service's files, median size in bytes, compressible)]
+# Plex has a lot of small metadata and artwork files, a couple of large databases and a big cache that is
+# excluded from backups. The *arrs are mostly a few databases, logs and their own backup zips.
+_PROFILES = {
+    "plex": [
+        ("Library/Application Support/Plex Media Server/Metadata", 0.6, 16 * 2**10, False),
+        ("Library/Application Support/Plex Media Server/Media", 0.2, 64 * 2**10, False),
+        ("Library/Application Support/Plex Media Server/Plug-in Support/Databases", 0.01, 8 * 2**20, True),
+        ("Library/Application Support/Plex Media Server/Logs", 0.04, 256 * 2**10, True),
+        ("Library/Application Support/Plex Media Server/Cache", 0.15, 32 * 2**10, False),
+    ],
+    **{
+        arr: [
+            ("", 0.05, 2 * 2**20, True),
+            ("logs", 0.6, 512 * 2**10, True),
+            ("Backups/scheduled", 0.15, 4 * 2**20, False),
+            ("MediaCover", 0.2, 48 * 2**10, False),
+        ]
+        for arr in ("sonarr", "radarr", "lidarr", "prowlarr")
+    },
+}
+_SHARES = {"plex": 0.6, "sonarr": 0.1, "radarr": 0.1, "lidarr": 0.1, "prowlarr": 0.1}
+_PLEX_CACHE = "Library/Application Support/Plex Media Server/Cache"
+
+
+def _synthetic_tree(root, files=2000, scale=1.0, seed=0):
+    """Populate `root` with a reproducible fake /srv tree of roughly `files` files"""
+    rng = random.Random(seed)
+    text = b"".join(b"%d INFO [Sonarr] Lorem ipsum dolor sit amet, consectetur adipiscing\n" % i for i in range(4096))
+    for service, dirs in _PROFILES.items():
+        for subdir, share, median, compressible in dirs:
+            (Path(root) / service / subdir).mkdir(parents=True, exist_ok=True)
+            for i in range(max(1, round(files * _SHARES[service] * share))):
+                size = min(int(rng.lognormvariate(math.log(median * scale), 1.0)), 64 * 2**20)
+                data = (text * (size // len(text) + 1))[:size] if compressible else rng.randbytes(size)
+                (Path(root) / service / subdir / f"{i:05}.bin").write_bytes(data)
+    for port, arr in enumerate(("sonarr", "radarr", "lidarr", "prowlarr"), start=8000):
+        (Path(root) / arr / "config.xml").write_text(f"<Config><Port>{port}</Port><ApiKey>{arr}</ApiKey></Config>")
+
+
+class _StandinHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _StandinSFTP(paramiko.SFTPServerInterface):
+    """Serve the local filesystem over sftp, with just enough operations for the fabfile"""
+
+    def _call(self, f, *args):
+        try:
+            return f(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        def listdir():
+            attrs = []
+            for name in os.listdir(path):
+                attrs.append(paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)), name))
+            return attrs
+
+        return self._call(listdir)
+
+    def stat(self, path):
+        return self._call(lambda: paramiko.SFTPAttributes.from_stat(os.stat(path)))
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        def open_():
+            f = os.fdopen(os.open(path, flags, 0o666), "r+b" if flags & (os.O_WRONLY | os.O_RDWR) else "rb")
+            handle = _StandinHandle(flags)
+            handle.filename, handle.readfile, handle.writefile = path, f, f
+            return handle
+
+        return self._call(open_)
+
+    def remove(self, path):
+        return self._call(lambda: os.remove(path) or paramiko.SFTP_OK)
+
+    def rename(self, old, new):
+        return self._call(lambda: os.rename(old, new) or paramiko.SFTP_OK)
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        return self._call(lambda: os.mkdir(path) or paramiko.SFTP_OK)
+
+    def chattr(self, path, attr):
+        if attr.st_size is not None:
+            return self._call(lambda: os.truncate(path, attr.st_size) or paramiko.SFTP_OK)
+        return paramiko.SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.abspath(path)
+
+
+class _StandinServer(paramiko.ServerInterface):
+    """Accept anyone and run exec requests through the local shell"""
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        def run():
+            p = subprocess.Popen(
+                command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+
+            def feed():
+                with contextlib.suppress(BrokenPipeError), p.stdin:
+                    while data := channel.recv(2**16):
+                        p.stdin.write(data)
+
+            threading.Thread(target=feed, daemon=True).start()
+            stderr = threading.Thread(target=lambda: channel.sendall_stderr(p.stderr.read()), daemon=True)
+            stderr.start()
+            while data := p.stdout.read1(2**16):
+                channel.sendall(data)
+            stderr.join()
+            channel.send_exit_status(p.wait())
+            channel.close()
+
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+
+def _serve(pipe):
+    """Run the ssh stand-in, this is meant to be the target of a separate process so that
+    its cpu time and memory are not measured along with the fabfile's."""
+    os.chdir(Path.home())
+    key, sock = paramiko.RSAKey.generate(2048), socket.create_server(("127.0.0.1", 0))
+    pipe.send(sock.getsockname()[1])
+    while True:
+        transport = paramiko.Transport(sock.accept()[0])
+        transport.add_server_key(key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _StandinSFTP)
+        transport.start_server(server=_StandinServer())
+
+
+def _benchmarks(conn, tree, scratch):
+    """Return {name: callable} of the hot paths to measure, each one is given a fresh output directory"""
+    excluded = [str(tree / "plex" / _PLEX_CACHE)]
+
+    def config(_):
+        utils._SERVICE_CONFIGS.clear()
+        return _load_service_config(disk_cache=False)
+
+    def compose(_):
+        utils._COMPOSE_MODELS.clear()
+        return [_get_service_compose(service) for service in _load_service_config()]
+
+    # restore_simple streams into /srv with sudo, restore into the output directory instead
+    scratch.mkdir(parents=True, exist_ok=True)
+    backup._generic_backup(conn, str(tree / "sonarr"), "sonarr", compressed=True, verbose=0, directory=scratch)
+
+    def restore(out):
+        backup._restore_service(conn, "sonarr", scratch / "sonarr.zip", pbar=False, root=str(out), sudo=False)
+
+    return {
+        "remote_walk": lambda _: list(_remote_walk(conn, str(tree / "plex"), exclude_dirs=excluded)),
+        "read_file": lambda _: [_read_file(conn, str(tree / arr / "config.xml")) for arr in ("sonarr", "radarr")],
+        "load_service_config": config,
+        "load_service_config_memo": lambda _: _load_service_config(),
+        "get_service_compose": compose,
+        **{
+            f"backup_{name}": (
+                lambda out, kwargs=kwargs: backup._generic_backup(
+                    conn, str(tree / "plex"), "plex", excluded=excluded, verbose=0, directory=out, **kwargs
+                )
+            )
+            for name, kwargs in {
+                "zip": {"compressed": True},
+                "tar": {"compressed": True, "archive": "tar"},
+                "uncompressed": {"compressed": False},
+            }.items()
+        },
+        "restore_simple": restore,
+    }
+
+
+def _git_commit():
+    """Current commit, suffixed with `+dirty` if the tree has local modifications"""
+    run = lambda *args: subprocess.run(["git", *args], capture_output=True, text=True).stdout.strip()
+    return (run("rev-parse", "--short", "HEAD") or "unknown") + ("+dirty" if run("status", "--porcelain") else "")
+
+
+def _load_results(path=None):
+    try:
+        with open(path or BENCH_PATH, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@task(
+    help={
+        "files": "Number of files in the synthetic /srv tree",
+        "scale": "Multiplier applied to all file sizes",
+        "repeat": "Time each benchmark this many times and keep the fastest",
+        "only": "Comma separated benchmarks to run (default: all)",
+        "save": f"Store results for the current commit in {BENCH_PATH}",
+    }
+)
+def run(_, files=2000, scale=1.0, repeat=3, only=None, save=True):
+    """Benchmark the fabfile's hot paths against a local ssh stand-in over a synthetic tree"""
+    if int(repeat) < 1:
+        raise Exit("--repeat must be at least 1, the fastest of the timed runs is kept.")
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve, args=(child,), daemon=True)
+    server.start()
+    workdir = Path(tempfile.mkdtemp(prefix="bench-"))
+    results = {}
+    try:
+        print(f"Generating {files} files in {workdir}...")
+        _synthetic_tree(workdir / "srv", int(files), float(scale))
+        connect_kwargs = {"password": "bench", "look_for_keys": False, "allow_agent": False}
+        conn = Connection("127.0.0.1", user=getpass.getuser(), port=parent.recv(), connect_kwargs=connect_kwargs)
+
+        benchmarks = _benchmarks(conn, workdir / "srv", workdir / "scratch")
+        for name in only.split(",") if only else benchmarks:
+            timings = []
+            for i in range(int(repeat) + 1):
+                out = workdir / "out" / f"{name}-{i}"
+                out.mkdir(parents=True)
+                # The last run is traced, tracemalloc slows everything down so it is not timed
+                if traced := i == int(repeat):
+                    tracemalloc.start()
+                    before = Counter(utils._ROUND_TRIPS[utils._CURRENT_TASK])
+                start = time.perf_counter()
+                benchmarks[name](out)
+                elapsed = time.perf_counter() - start
+                if traced:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    trips = Counter(utils._ROUND_TRIPS[utils._CURRENT_TASK]) - before
+                else:
+                    timings.append(elapsed)
+                shutil.rmtree(out)
+            results[name] = {
+                "seconds": round(min(timings), 4),
+                "channels": trips["channels"],
+                "sftp": trips["sftp"],
+                "peak_mb": round(peak / 2**20, 2),
+            }
+            print(
+                f"{name:<28}{results[name]['seconds']:>9.3f}s{trips['channels']:>6} channels"
+                f"{trips['sftp']:>8} sftp{results[name]['peak_mb']:>10.2f} MB"
+            )
+        conn.close()
+    finally:
+        server.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if save:
+        history = _load_results()
+        entry = history.setdefault(_git_commit(), {"results": {}})
+        entry["date"] = datetime.datetime.now().isoformat(timespec="seconds")
+        entry["params"] = {"files": int(files), "scale": float(scale), "repeat": int(repeat)}
+        entry["results"].update(results)
+        with open(BENCH_PATH, "w") as f:
+            json.dump(history, f, indent=2)
+    return results
+
+
+@task(help={"base": "Commit to compare against (default: second to last run)", "head": "Default: last run"})
+def compare(_, base=None, head=None):
+    """Show the change in time, round trips and memory between two benchmarked commits"""
+    history = _load_results()
+    if len(history) < 2 and not (base and head):
+        print(f"Need at least two benchmarked commits in {BENCH_PATH}, run `fab bench.run` first.")
+        return
+    base, head = base or list(history)[-2], head or list(history)[-1]
+    print(f"{'':<28}{base:>14}{head:>14}{'change':>10}")
+    for name, new in history[head]["results"].items():
+        if not (old := history[base]["results"].get(name)):
+            continue
+        for metric in ("seconds", "channels", "sftp", "peak_mb"):
+            change = (new[metric] - old[metric]) / old[metric] if old[metric] else 0
+            print(f"{name + '.' + metric:<28}{old[metric]:>14}{new[metric]:>14}{change:>+10.0%}")
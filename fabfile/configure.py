@@ -1,7 +1,6 @@
 import json
 
 import keyring
-from fabric import task
 from ruamel.yaml import YAML
 
 from fabfile import status
@@ -18,7 +17,13 @@ from fabfile.defaults import (
     TRANSMISSION_PATH,
     TRANSMISSION_REMOTE_FILE,
 )
-from fabfile.utils import _get_hostname, _get_jinja_env, _load_service_config, _put_mv
+from fabfile.utils import (
+    _get_hostname,
+    _get_jinja_env,
+    _load_service_config,
+    _put_mv,
+    task,
+)
 
 
 @task
@@ -10,20 +10,37 @@ TRANSMISSION_REMOTE_FILE = "settings.json"
 DCP = f"docker-compose -f {COMPOSE_REMOTE_ROOT}/{COMPOSE_FILE}"
 # MEDIA_REMOTE_ROOT = "/mnt/mybook/srv/media/"
 MEDIA_REMOTE_ROOT = "/vault/media/"
+IP_ECHO_URL = "https://ipleak.net/json/"
+TRANSFER_CHUNK_SIZE = 4 * 2**20
+TRANSFER_WINDOW = 16
+# Zip backups hold at most ZIP_BUFFER_SIZE bytes of files (plus their compressed copies) in memory at once,
+# files of ZIP_STREAM_SIZE bytes or more are written to the archive as they download instead
+ZIP_BUFFER_SIZE = 64 * 2**20
+ZIP_STREAM_SIZE = 16 * 2**20
 
 LOCAL_ROOT = "."
 BACKUP_DIR = "backup"
+STORE_DIR = ".store"
+INDEX_FILE = "index.json"
 DOCKERFILE_DIR = "dockerfiles"
 PROFILE_FILE = ".profile"
 SERVICES_FILE = "services.yml"
 HOMER_FILE = "homer-config.yml"
 TRANSMISSION_FILE = "transmission-config.yml"
 MOSQUITTO_FILE = "mosquitto.conf"
+METRICS_FILE = "metrics.sqlite"
+BENCH_FILE = "benchmarks.json"
+INVENTORY_FILE = "hosts.yml"
 SERVICES_PATH = Path(LOCAL_ROOT) / SERVICES_FILE
 COMPOSE_PATH = Path(LOCAL_ROOT) / COMPOSE_FILE
 PROFILE_PATH = Path(LOCAL_ROOT) / PROFILE_FILE
 HOMER_PATH = Path(LOCAL_ROOT) / HOMER_FILE
 TRANSMISSION_PATH = Path(LOCAL_ROOT) / TRANSMISSION_FILE
 BACKUP_PATH = Path(LOCAL_ROOT) / BACKUP_DIR
+STORE_PATH = BACKUP_PATH / STORE_DIR
 DOCKERFILE_PATH = Path(LOCAL_ROOT) / DOCKERFILE_DIR
 MOSQUITTO_PATH = Path(LOCAL_ROOT) / MOSQUITTO_FILE
+METRICS_PATH = Path(LOCAL_ROOT) / METRICS_FILE
+BENCH_PATH = Path(LOCAL_ROOT) / BENCH_FILE
+INVENTORY_PATH = Path(LOCAL_ROOT) / INVENTORY_FILE
+CACHE_PATH = Path.home() / ".cache" / "webservices"
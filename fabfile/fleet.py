@@ -0,0 +1,171 @@
+import io
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+from fabric import Connection
+from fabric.runners import Remote
+from invoke.exceptions import Exit, UnexpectedExit
+from ruamel.yaml import YAML
+
+from fabfile.defaults import INVENTORY_PATH
+from fabfile.utils import _get_jinja_env, _keyring_get, task
+
+HostResult = namedtuple("HostResult", ["name", "host", "ok", "seconds", "result", "output"])
+
+# Collections whose tasks write shared local state named by time (i.e: backup snapshots), these run one host at a time
+_SERIAL_COLLECTIONS = {"backup"}
+
+# Output buffer of the host the current thread is working on, see `_HostStream`
+_HOST_OUTPUT = threading.local()
+
+
+class _HostStream:
+    """Stand-in for sys.stdout/sys.stderr which sends anything written from a fleet worker
+    thread to it's host's buffer, and everything else to the real stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, s):
+        return (getattr(_HOST_OUTPUT, "buffer", None) or self.stream).write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        return getattr(_HOST_OUTPUT, "buffer", None) is None and self.stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class _HostRemote(Remote):
+    """Remote runner which writes command output meant for the terminal to it's host's buffer. Runners write
+    from their own threads, which `_HostStream` can't tell apart, and passing the buffer as `out_stream`
+    would show output the task hides."""
+
+    def __init__(self, *args, buffer=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer = buffer
+
+    def write_our_output(self, stream, string):
+        super().write_our_output(self.buffer if isinstance(stream, _HostStream) else stream, string)
+
+
+def _load_inventory(inventory=None, root=None):
+    """Load the host inventory as {name: {"host": "[user@]addr[:port]", "groups": [...], ...}}. Hosts are given as
+    either a host string or a mapping with `host`, `groups` and `connect_kwargs` keys. Like the services config the
+    file is jinja-templated, so passwords can be fetched with `keyring_get`."""
+    text = _get_jinja_env(root).get_template(str(inventory or INVENTORY_PATH)).render(keyring_get=_keyring_get)
+    hosts = YAML(typ="safe").load(text) or {}
+    return {name: {"host": entry} if isinstance(entry, str) else entry for name, entry in hosts.items()}
+
+
+def _select_hosts(inventory, hosts=None, group=None):
+    """Pick inventory entries by (comma separated) names and/or groups, all of them by default"""
+    names = set(hosts.split(",")) if hosts else set()
+    groups = set(group.split(",")) if group else set()
+    if unknown := names - set(inventory):
+        raise ValueError(f"Unknown host(s) {', '.join(sorted(unknown))}, check the inventory.")
+    return {
+        name: entry
+        for name, entry in inventory.items()
+        if (not names and not groups) or name in names or groups.intersection(entry.get("groups", []))
+    }
+
+
+def _task_kwargs(args=None):
+    """Parse task arguments given as `key=value,key=value`, values are YAML scalars (i.e: `jobs=2,force=true`)"""
+    kwargs = {}
+    for arg in args.split(",") if args else []:
+        key, _, value = arg.partition("=")
+        kwargs[key.strip().replace("-", "_")] = YAML(typ="safe").load(value) if value else True
+    return kwargs
+
+
+def _summarize(e):
+    if isinstance(e, UnexpectedExit):
+        return f"exit code {e.result.exited}: {e.result.command}"
+    return f"{type(e).__name__}: {next(iter(str(e).strip().splitlines()), '')}"
+
+
+def _run_on_host(c, name, entry, target, kwargs):
+    """Run task `target` against one inventory host, capturing everything it outputs"""
+    buffer = _HOST_OUTPUT.buffer = io.StringIO()
+    config = c.config.clone()
+    config.runners.remote = partial(_HostRemote, buffer=buffer)
+    config.run.in_stream = False
+    start, conn = time.time(), None
+    try:
+        conn = Connection(
+            entry["host"],
+            config=config,
+            connect_kwargs={**config.connect_kwargs, **entry.get("connect_kwargs", {})},
+        )
+        ok, result = True, target(conn, **kwargs)
+    except Exception as e:
+        ok, result = False, _summarize(e)
+        print(f"{type(e).__name__}: {e}")
+    finally:
+        _HOST_OUTPUT.buffer = None
+        if conn is not None:
+            conn.close()
+    return HostResult(name, entry["host"], ok, time.time() - start, result, buffer.getvalue())
+
+
+@task(
+    help={
+        "name": "Task to run on each host, i.e: `status.vpn`",
+        "hosts": "Comma separated host names from the inventory (all hosts by default)",
+        "group": "Comma separated groups, run on the hosts that are in any of them",
+        "args": "Task arguments as `key=value,key=value`",
+        "jobs": "Number of hosts to run on concurrently",
+        "logs": "Directory to save each host's output to, as <host>.log",
+        "quiet": "Only print the result table, not each host's output",
+    }
+)
+def run(c, name, hosts=None, group=None, args=None, inventory=None, root=None, jobs=8, logs=None, quiet=False):
+    """Run a task on several hosts from the inventory (hosts.yml) concurrently"""
+    from fabfile import (
+        ns,  # Not at import time, the namespace is built from this module
+    )
+
+    target, kwargs = ns[name], _task_kwargs(args)
+    selected = _select_hosts(_load_inventory(inventory, root), hosts, group)
+    if not selected:
+        raise Exit("No hosts selected, check the inventory, --hosts and --group.")
+    if name.split(".")[0] in _SERIAL_COLLECTIONS and int(jobs) > 1:
+        print(f"Running {name} one host at a time, it writes to local directories shared by all hosts.")
+        jobs = 1
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _HostStream(stdout), _HostStream(stderr)
+    try:
+        with ThreadPoolExecutor(max_workers=int(jobs)) as executor:
+            futures = [executor.submit(_run_on_host, c, *item, target, kwargs) for item in selected.items()]
+            results = [future.result() for future in futures]
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    for result in results:
+        if logs:
+            Path(logs).mkdir(parents=True, exist_ok=True)
+            (Path(logs) / f"{result.name}.log").write_text(result.output)
+        if not quiet and result.output:
+            print(f"==> {result.name} ({result.host}) <==")
+            print(result.output.rstrip("\n"), end="\n\n")
+
+    width = max(len(result.name) for result in results) + 2
+    print(f"{'host':<{width}}{'status':<8}{'time':>8}  result")
+    for result in results:
+        summary = "" if result.result is None else str(result.result).replace("\n", " ")
+        summary = summary if len(summary) <= 80 else f"{summary[:77]}..."
+        print(f"{result.name:<{width}}{'ok' if result.ok else 'failed':<8}{result.seconds:>7.1f}s  {summary}")
+
+    if failed := [result.name for result in results if not result.ok]:
+        raise Exit(f"{name} failed on {len(failed)} of {len(results)} hosts: {', '.join(failed)}", code=1)
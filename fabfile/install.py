@@ -1,54 +1,165 @@
-from fabric import task
+import queue
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from fabfile.utils import _check_run, _get_py_version, _put_mv
+from fabfile.utils import _clone_connection, _put_mv, _run, _run_sections, task
 
+# An installable tool: `check` succeeds if it's installed, `requires` are installed first
+# and tools that use `apt` never install concurrently (they'd fight over dpkg's lock).
+Tool = namedtuple("Tool", ["name", "check", "commands", "sudo", "requires", "apt"])
 
-@task(default=True, aliases=["install"])
-def all(c, force=False):
-    """Run all Install sub-tasks"""
-    croc(c, force=force)
-    docker(c, force=force)
-    docker_compose(c, force=force)
-    lazydocker(c, force=force)
-    python3(c, force=force)
-    speedtest(c, force=force)
-
-
-@task
-def docker(c, force=False):
-    """Install docker if not present"""
-    _check_run(
-        c,
+_TOOLS = {
+    "python3": Tool(
+        "Python3",
+        "python3 -m pip -V",
+        [
+            "apt-get install -y libffi-dev libssl-dev",
+            "apt-get install -y python3-dev",
+            "apt-get install -y python3 python3-pip ",
+        ],
+        sudo=True,
+        requires=(),
+        apt=True,
+    ),
+    "docker": Tool(
+        "Docker",
         "docker -v",
         [
             # "curl -sSL https://get.docker.com | sh"
             "curl -fsSL https://get.docker.com -o get-docker.sh",
             "sh get-docker.sh",
             "usermod -aG docker ${USER}",
-            "chmod 666 /var/run/docker.sock" "systemctl enable docker",
+            "chmod 666 /var/run/docker.sock",
+            "systemctl enable docker",
             "rm -f get-docker.sh",
         ],
-        on_fail="Docker is already installed, skipping...",
         sudo=True,
-        force=force,
-    )
+        requires=(),
+        apt=True,
+    ),
+    "docker_compose": Tool(
+        "Docker-compose",
+        "docker-compose --version",
+        ["python3 -m pip install docker-compose"],
+        sudo=True,
+        requires=("python3", "docker"),
+        apt=False,
+    ),
+    "lazydocker": Tool(
+        "Lazy-docker",
+        "test -f ~/.local/bin/lazydocker",  # not sure why `lazydocker --version` doesn't work...
+        [
+            "curl https://raw.githubusercontent.com/jesseduffield/lazydocker/master/scripts/install_update_linux.sh | bash",
+            "rm lazydocker",  # Don't worry it's in ~/.local/bin still
+        ],
+        sudo=True,
+        requires=(),
+        apt=False,
+    ),
+    "speedtest": Tool(
+        "Speedtest",
+        "speedtest --version",
+        ["apt install -y speedtest-cli"],
+        sudo=True,
+        requires=(),
+        apt=True,
+    ),
+    "croc": Tool(
+        "Croc",
+        "croc -v",
+        ["curl https://getcroc.schollz.com | bash"],
+        sudo=False,
+        requires=(),
+        apt=False,
+    ),
+    "jc": Tool(
+        "JC",
+        "~/.local/bin/jc -v",
+        ["python3 -m pip install jc"],
+        sudo=False,
+        requires=("python3",),
+        apt=False,
+    ),
+}
+
+
+def _install_order(names):
+    """Expand tool `names` with their requirements, each tool once and after its requirements"""
+    order = []
+
+    def visit(name):
+        if name not in order:
+            for requirement in _TOOLS[name].requires:
+                visit(requirement)
+            order.append(name)
+
+    for name in names:
+        visit(name)
+    return order
+
+
+def _install(c, names, force=False, jobs=4):
+    """Install tools `names` and their requirements if not present. All tools are checked in a single round trip,
+    missing ones are installed concurrently (on up to `jobs` connections) once their requirements are."""
+    order = _install_order(names)
+    probe = _run_sections(c, {name: f"{_TOOLS[name].check} >/dev/null && echo ok" for name in order})
+    missing = [name for name in order if force or not probe.get(name)]
+    for name in order:
+        if name not in missing:
+            print(f"{_TOOLS[name].name} is already installed, skipping...")
+    if not missing:
+        return
+
+    pool = queue.Queue()
+    pool.put(c)
+    for _ in range(min(int(jobs), len(missing)) - 1):
+        pool.put(_clone_connection(c))
+
+    def install(name):
+        conn = pool.get()
+        try:
+            for command in _TOOLS[name].commands:
+                _run(conn, command, sudo=_TOOLS[name].sudo)
+        finally:
+            pool.put(conn)
+
+    # Start tools whose requirements are installed, at most one apt tool at a time, until none are left
+    pending, running = list(missing), {}
+    try:
+        with ThreadPoolExecutor(max_workers=int(jobs)) as executor:
+            while pending or running:
+                busy = set(pending) | set(running.values())
+                for name in list(pending):
+                    apt = _TOOLS[name].apt and any(_TOOLS[other].apt for other in running.values())
+                    if len(running) < int(jobs) and not apt and not busy.intersection(_TOOLS[name].requires):
+                        running[executor.submit(install, name)] = name
+                        pending.remove(name)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+                    future.result()
+    finally:
+        while not pool.empty():
+            if (conn := pool.get()) is not c:
+                conn.close()
+
+
+@task(default=True, aliases=["install"], help={"jobs": "Number of tools to install concurrently"})
+def all(c, force=False, jobs=4):
+    """Run all Install sub-tasks"""
+    _install(c, ["croc", "docker", "docker_compose", "lazydocker", "python3", "speedtest"], force=force, jobs=jobs)
+
+
+@task
+def docker(c, force=False):
+    """Install docker if not present"""
+    _install(c, ["docker"], force=force)
 
 
 @task(aliases=["dcp"])
 def docker_compose(c, force=False):
     """Install docker-compose if not present"""
-    # Call dependencies, this should be done via pre-tasks
-    # but theres a bug on windows (https://github.com/fabric/fabric/issues/2202)
-    python3(c, force=force)
-    docker(c, force=force)
-    _check_run(
-        c,
-        "docker-compose --version",
-        "python3 -m pip install docker-compose",
-        on_fail="Docker-compose is already installed, skipping...",
-        sudo=True,
-        force=force,
-    )
+    _install(c, ["docker_compose"], force=force)
 
 
 @task
@@ -85,70 +196,28 @@ def elodie(c, force=False):
 @task(aliases=["lzd"])
 def lazydocker(c, force=False):
     """Install the lazy docker manager"""
-    _check_run(
-        c,
-        "test -f ~/.local/bin/lazydocker",  # not sure why `lazydocker --version` doesn't work...
-        [
-            "curl https://raw.githubusercontent.com/jesseduffield/lazydocker/master/scripts/install_update_linux.sh | bash",
-            "rm lazydocker",  # Don't worry it's in ~/.local/bin still
-        ],
-        on_fail="Lazy-docker is already installed, skipping...",
-        sudo=True,
-        force=force,
-    )
+    _install(c, ["lazydocker"], force=force)
 
 
 @task(aliases=["py3"])
 def python3(c, force=False):
     """Install python3 (and pip!) if not present"""
-    _check_run(
-        c,
-        "python3 -m pip -V",
-        [
-            "apt-get install -y libffi-dev libssl-dev",
-            "apt-get install -y python3-dev",
-            "apt-get install -y python3 python3-pip ",
-        ],
-        on_fail="Python3 is already installed, skipping...",
-        sudo=True,
-        force=force or _get_py_version(c)[0] < 3,
-    )
+    _install(c, ["python3"], force=force)
 
 
 @task
 def speedtest(c, force=False):
     """Install Ookla's speedtest client on host"""
-    _check_run(
-        c,
-        "speedtest --version",
-        "apt install speedtest-cli",
-        on_fail="Speedtest is already installed, skipping...",
-        sudo=True,
-        force=force,
-    )
+    _install(c, ["speedtest"], force=force)
 
 
 @task
 def croc(c, force=False):
     """Install croc: a tool to send and receive files"""
-    _check_run(
-        c,
-        "croc -v",
-        "curl https://getcroc.schollz.com | bash",
-        on_fail="Croc is already installed, skipping...",
-        sudo=False,
-        force=force,
-    )
+    _install(c, ["croc"], force=force)
 
 
 @task
 def jc(c, force=False):
     """Install jc, a cli parser for common tools"""
-    python3(c, force=force)
-    _check_run(
-        c,
-        "~/.local/bin/jc -v",
-        "python3 -m pip install jc",
-        on_fail="JC is already installed, skipping...",
-        force=force,
-    )
+    _install(c, ["jc"], force=force)
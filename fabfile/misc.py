@@ -1,3 +1,5 @@
+import atexit
+import hashlib
 import io
 import re
 import sys
@@ -7,7 +9,6 @@ import fabric.main
 import invoke.program
 import requests
 from bs4 import BeautifulSoup
-from fabric import task
 
 from fabfile import install
 from fabfile.defaults import (
@@ -25,14 +26,20 @@ from fabfile.defaults import (
     SERVICES_REMOTE_ROOT,
 )
 from fabfile.utils import (
+    _ROUND_TRIPS,
+    _changed_compose_services,
     _clone_or_pull,
-    _get_hostname,
+    _enable_tracing,
     _get_jinja_env,
     _get_service_compose,
     _load_service_config,
     _put_mv,
     _read_file,
     _run,
+    _run_sections,
+    _trace_summary,
+    _write_chrome_trace,
+    task,
 )
 
 
@@ -65,58 +72,82 @@ def set_swap_size(c, size=None):
     print("Please reboot host for changes to take effect.")
 
 
+# Convenience packages installed by `deploy`, as {apt package: check command}
+_CONVENIENCE_PACKAGES = {"tmux": "tmux -V", "ncdu": "ncdu -V", "bat": "batcat -V"}
+
+
 @task
-def deploy(c, services_config=None, root=None, force=False, update=False):
-    """Install services with docker-compose"""
+def deploy(c, services_config=None, root=None, force=False, update=False, restart=True):
+    """Install services with docker-compose, only upload (and restart) what changed"""
     if update:
         apt_update(c)
     install.docker_compose(c, force=force)
 
-    # Get dashboard icons, create /srv directory
-    _clone_or_pull(
+    # Probe the remote in one go: deployed files' hashes, hostname, dashboard icons and convenience packages
+    targets = {
+        "compose": (COMPOSE_REMOTE_ROOT, COMPOSE_FILE),
+        "profile": ("~", PROFILE_FILE),
+        "homer": (f"{SERVICES_REMOTE_ROOT}/homer", HOMER_REMOTE_FILE),
+    }
+    icons = f"{SERVICES_REMOTE_ROOT}/dashboard-icons/"
+    probe = _run_sections(
         c,
-        "https://github.com/walkxcode/dashboard-icons",
-        f"{SERVICES_REMOTE_ROOT}/dashboard-icons/",
+        {
+            "hostname": "hostname -I",
+            "icons": f"test -d {icons}.git && echo ok",
+            **{name: f"sha256sum {d}/{f} || sudo -n sha256sum {d}/{f}" for name, (d, f) in targets.items()},
+            **{package: f"{check} >/dev/null && echo ok" for package, check in _CONVENIENCE_PACKAGES.items()},
+        },
     )
 
-    # Move and render docker-compose and .profile
+    # Get dashboard icons (only pulled when updating), create /srv directory
+    if update or not probe["icons"]:
+        _clone_or_pull(c, "https://github.com/walkxcode/dashboard-icons", icons)
+
+    # Render docker-compose, .profile and homer's config
     env = _get_jinja_env(root)
     services = _load_service_config(services_config, root)
-    dcp = env.get_template(str(COMPOSE_PATH))
-    dcp = dcp.render(
-        **services,
-        MEDIA_REMOTE_ROOT=MEDIA_REMOTE_ROOT,
-        SERVICES_REMOTE_ROOT=SERVICES_REMOTE_ROOT,
-    )
-    _put_mv(c, dcp, COMPOSE_REMOTE_ROOT, raw=True, filename=COMPOSE_FILE)
-
-    # Upload and source profile script
-    profile = env.get_template(str(PROFILE_PATH))
-    profile = profile.render(DCP=DCP)
-    _put_mv(c, profile, "~", raw=True, filename=PROFILE_FILE)
-    c.run(f"source {PROFILE_FILE}")
-
-    # Render homer's config and upload it
-    homer_config = env.get_template(str(HOMER_PATH))
-    homer_config = homer_config.render(
-        **services,
-        hostname=_get_hostname(c),
-    )
-    _put_mv(
-        c,
-        homer_config,
-        f"{SERVICES_REMOTE_ROOT}/homer/",
-        raw=True,
-        filename=HOMER_REMOTE_FILE,
-    )
+    rendered = {
+        "compose": env.get_template(str(COMPOSE_PATH)).render(
+            **services,
+            MEDIA_REMOTE_ROOT=MEDIA_REMOTE_ROOT,
+            SERVICES_REMOTE_ROOT=SERVICES_REMOTE_ROOT,
+        ),
+        "profile": env.get_template(str(PROFILE_PATH)).render(DCP=DCP),
+        "homer": env.get_template(str(HOMER_PATH)).render(**services, hostname=probe["hostname"].split(" ")[0]),
+    }
+
+    # Only upload the files whose hash differs from the remote copy's
+    changed = [
+        name
+        for name, text in rendered.items()
+        if force or probe[name].split(" ")[0] != hashlib.sha256(text.encode("utf-8")).hexdigest()
+    ]
+    if not changed:
+        print("Deployed files are up to date.")
+
+    # Find the services whose (rendered) compose block changed if they were deployed before, stop removed ones
+    # while the previous compose file still describes them
+    restarted = []
+    if "compose" in changed and probe["compose"] and restart:
+        previous = c.run(f"cat {COMPOSE_REMOTE_ROOT}/{COMPOSE_FILE}", hide=True).stdout
+        restarted, removed = _changed_compose_services(previous, rendered["compose"])
+        if removed:
+            print(f"Removing {', '.join(removed)}...")
+            c.run(f"{DCP} rm -sf {' '.join(removed)}")
+
+    for name in changed:
+        print(f"Uploading {targets[name][1]}...")
+        _put_mv(c, rendered[name], targets[name][0], raw=True, filename=targets[name][1])
+    if "profile" in changed:
+        c.run(f"source {PROFILE_FILE}")
+    if restarted:
+        print(f"Restarting {', '.join(restarted)}...")
+        c.run(f"{DCP} up -d {' '.join(restarted)}")
 
     # Install convenience packages
-    if c.run("tmux -V", hide=True, warn=True).failed:
-        c.sudo("apt-get install tmux -y")
-    if c.run("ncdu -V", hide=True, warn=True).failed:
-        c.sudo("apt-get install ncdu -y")
-    if c.run("batcat -V", hide=True, warn=True).failed:
-        c.sudo("apt-get install bat -y")
+    if missing := [package for package in _CONVENIENCE_PACKAGES if not probe[package]]:
+        c.sudo(f"apt-get install {' '.join(missing)} -y")
 
 
 @task
@@ -187,6 +218,27 @@ def format(c, check=False, root=None):
     _run(c, f"black --line-length={MAX_LINE_LENGTH} {black_options} {root or '.'}")
 
 
+@task(aliases=["rtt"])
+def round_trips(_):
+    """Show round trips used by the previous tasks, i.e: `fab backup misc.rtt`"""
+    for name, counts in _ROUND_TRIPS.items():
+        print(f"{name:<30}{counts['channels']:>8} channels{counts['sftp']:>10} sftp requests")
+
+
+@task(help={"output": "Also save a chrome trace (open with chrome://tracing or ui.perfetto.dev) to this file"})
+def trace(_, output=None):
+    """Trace remote calls of the following tasks and summarize them on exit, i.e: `fab misc.trace backup`"""
+    events = _enable_tracing()
+
+    def report():
+        _trace_summary(events)
+        if output:
+            _write_chrome_trace(events, output)
+            print(f"Saved {len(events)} events to {output}")
+
+    atexit.register(report)
+
+
 @task
 def clear_metadata(c):
     _run(
@@ -1,22 +1,42 @@
 import configparser
 import glob
+import itertools
 import json
+import re
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import humanize
 import keyring
-from fabric import task
+from invoke.exceptions import CommandTimedOut
 from ruamel.yaml import YAML
 
 from fabfile import install
-from fabfile.defaults import DCP, DOCKERFILE_PATH, SERVICES_REMOTE_ROOT
+from fabfile.defaults import (
+    BACKUP_PATH,
+    DCP,
+    DOCKERFILE_PATH,
+    IP_ECHO_URL,
+    MEDIA_REMOTE_ROOT,
+    METRICS_PATH,
+    SERVICES_REMOTE_ROOT,
+)
 from fabfile.utils import (
-    _get_service_compose,
+    _compose_model,
+    _diff_listings,
     _get_xml_value,
+    _listing,
     _load_service_config,
+    _previous_listing,
     _print_dicts,
     _put_mv,
     _read_file,
+    _remote_walk,
+    _run_sections,
+    task,
 )
 
 
@@ -92,6 +112,130 @@ def get_arrport(c, service, encoding="utf-8"):
     )
 
 
+_SIZE_UNITS = {"b": 1, "kb": 10**3, "mb": 10**6, "gb": 10**9, "tb": 10**12}
+_SIZE_UNITS.update({"kib": 2**10, "mib": 2**20, "gib": 2**30, "tib": 2**40})
+
+
+def _parse_size(size):
+    """Parse docker's human readable sizes, i.e: `12.5MiB`"""
+    if not (m := re.match(r"([\d.]+)\s*([a-zA-Z]+)", size.strip())):
+        return 0.0
+    return float(m[1]) * _SIZE_UNITS.get(m[2].lower(), 1)
+
+
+def _sample_metrics(c):
+    """Gather power, battery, per-container and disk usage in one round trip as {metric: value}"""
+    out = _run_sections(
+        c,
+        {
+            "power": "cat /sys/class/power_supply/BAT*/power_now",
+            "battery": "cat /sys/class/power_supply/BAT*/capacity",
+            "docker": "docker stats --no-stream --format '{{json .}}'",
+            "disk": f"df -B1 --output=target,used,size / {SERVICES_REMOTE_ROOT} {MEDIA_REMOTE_ROOT} | tail -n +2",
+        },
+    )
+    metrics = {}
+    if out.get("power"):
+        metrics["power_w"] = int(out["power"].split()[0]) * 1e-6
+    if out.get("battery"):
+        metrics["battery_pct"] = float(out["battery"].split()[0])
+    for line in out.get("docker", "").splitlines():
+        stats = json.loads(line)
+        metrics[f"cpu_pct:{stats['Name']}"] = float(stats["CPUPerc"].rstrip("%") or 0)
+        metrics[f"mem_bytes:{stats['Name']}"] = _parse_size(stats["MemUsage"].split("/")[0])
+    for line in out.get("disk", "").splitlines():
+        target, used, size = line.split()
+        metrics[f"disk_used:{target}"] = float(used)
+        metrics[f"disk_size:{target}"] = float(size)
+    return metrics
+
+
+def _metrics_db(path=None):
+    db = sqlite3.connect(path or METRICS_PATH)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS samples "
+        "(host TEXT, metric TEXT, resolution INTEGER, ts REAL, value REAL, min REAL, max REAL, count INTEGER)"
+    )
+    # Databases created before rollups were weighted, each of their rows counts as one sample
+    if "count" not in {column[1] for column in db.execute("PRAGMA table_info(samples)")}:
+        db.execute("ALTER TABLE samples ADD COLUMN count INTEGER NOT NULL DEFAULT 1")
+    db.execute("CREATE INDEX IF NOT EXISTS samples_idx ON samples (host, metric, resolution, ts)")
+    return db
+
+
+def _downsample(db, now, policy=((0, 300, 24 * 3600), (300, 3600, 30 * 24 * 3600))):
+    """Roll up old samples: for each (resolution, to_resolution, age) in policy, samples at
+    `resolution` older than `age` seconds are replaced by their mean/min/max over `to_resolution`.
+    Only whole buckets are rolled up, and means are weighted by the number of samples of each row."""
+    for resolution, to_resolution, age in policy:
+        cutoff = (now - age) // to_resolution * to_resolution
+        with db:
+            db.execute(
+                "INSERT INTO samples (host, metric, resolution, ts, value, min, max, count) "
+                "SELECT host, metric, ?, CAST(ts / ? AS INTEGER) * ?, SUM(value * count) / SUM(count), MIN(min), "
+                "MAX(max), SUM(count) FROM samples WHERE resolution = ? AND ts < ? "
+                "GROUP BY host, metric, CAST(ts / ? AS INTEGER)",
+                (to_resolution, to_resolution, to_resolution, resolution, cutoff, to_resolution),
+            )
+            db.execute("DELETE FROM samples WHERE resolution = ? AND ts < ?", (resolution, cutoff))
+
+
+@task(
+    help={
+        "interval": "Seconds between samples",
+        "duration": "Stop after this many seconds, run forever if 0",
+        "db": f"SQLite file to append samples to (default: {METRICS_PATH})",
+    }
+)
+def monitor(c, interval=10, duration=0, db=None, verbose=False):
+    """Periodically sample power, battery, container and disk usage into a local database"""
+    db, start, host = _metrics_db(db), time.time(), getattr(c, "host", "localhost")
+    print(f"Sampling {host} every {interval}s, press Ctrl+C to stop...")
+    try:
+        for tick in itertools.count():
+            now = time.time()
+            metrics = _sample_metrics(c)
+            with db:
+                db.executemany(
+                    "INSERT INTO samples (host, metric, resolution, ts, value, min, max, count) "
+                    "VALUES (?, ?, 0, ?, ?, ?, ?, 1)",
+                    [(host, k, now, v, v, v) for k, v in metrics.items()],
+                )
+            if verbose:
+                print(json.dumps(metrics, sort_keys=True))
+            if tick % 60 == 0:
+                _downsample(db, now)
+            if duration and now - start >= float(duration):
+                break
+            time.sleep(max(0, float(interval) - (time.time() - now)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close()
+
+
+@task(help={"verbose": "Also list the changed files"})
+def churn(c, verbose=False):
+    """Show what changed on the host for each service since it's last backup, and how much per day"""
+    services = sorted({path.name.removesuffix(".listing.json") for path in BACKUP_PATH.glob("*/*.listing.json")})
+    churn = {}
+    print(f"{'':<16}{'added':>8}{'modified':>10}{'deleted':>9}{'changed':>12}{'per day':>12}  since")
+    for service in services:
+        snapshot, previous = _previous_listing(service)
+        files = _remote_walk(c, previous["root"], exclude_dirs=previous["excluded"])
+        churn[service] = diff = _diff_listings(previous, _listing(files, previous["root"], previous["excluded"]))
+        days = max((time.time() - previous["time"]) / (24 * 3600), 1)
+        print(
+            f"{service:<16}{len(diff.added):>8}{len(diff.modified):>10}{len(diff.deleted):>9}"
+            f"{humanize.naturalsize(diff.bytes):>12}{humanize.naturalsize(diff.bytes / days):>12}  {snapshot.name}"
+        )
+        if verbose:
+            for kind in ("added", "modified", "deleted"):
+                for path in getattr(diff, kind):
+                    print(f"    {kind:<10}{path}")
+    return churn
+
+
 @task(incrementable=["verbose"])
 def speedtest(c, container="gluetun", verbose=0):
     """Run speedtest in given container, or host if empty"""
@@ -126,60 +270,107 @@ def bat_power(c):
     c.run("""awk '{print $1*10^-6 " W"}' /sys/class/power_supply/BAT*/power_now""")
 
 
-@task(incrementable=["verbose"])
-def vpn(c, verbose=0, full=False, services_config=None, root=None, dcp_path=None):
+def _parse_arr_config(service, text):
+    """Parse an *arr's config.xml into {key: value}, Bazarr's config.yaml is mapped onto the same keys"""
+    if not text:
+        return {}
+    if service.lower() == "bazarr":
+        conf = YAML(typ="safe").load(text) or {}
+        return {"ApiKey": conf.get("auth", {}).get("apikey"), "Port": conf.get("general", {}).get("port")}
+    return {child.tag: child.text for child in ET.fromstring(text)}
+
+
+@task(help={"indent": "Indentation of the printed json, use 0 for a single line"})
+def snapshot(c, services_config=None, root=None, indent=2, verbose=True):
+    """Gather battery, compose and *arr config state in a single round trip, as json"""
+    arrs = [service for service in _load_service_config(services_config, root) if service.lower().endswith("arr")]
+    commands = {
+        "services": f"{DCP} ps --services",
+        "running": f'{DCP} ps --services --filter "status=running"',
+        "battery": "cat /sys/class/power_supply/BAT*/uevent",
+        **{
+            f"arr:{service}": f"cat {SERVICES_REMOTE_ROOT}/{service}/"
+            + ("config/config.yaml" if service.lower() == "bazarr" else "config.xml")
+            for service in arrs
+        },
+    }
+    out = _run_sections(c, commands)
+    battery = dict(line.split("=", 1) for line in out["battery"].splitlines() if "=" in line)
+    services, running = out["services"].split(), out["running"].split()
+    snap = {
+        "host": getattr(c, "host", "localhost"),
+        "time": time.time(),
+        "battery": {k.removeprefix("POWER_SUPPLY_").lower(): v for k, v in battery.items()},
+        "services": {service: service in running for service in services},
+        "arrs": {service: _parse_arr_config(service, out[f"arr:{service}"]) for service in arrs},
+    }
+    if verbose:
+        print(json.dumps(snap, indent=int(indent) or None))
+    return snap
+
+
+def _probe_ip(c, container=None, url=IP_ECHO_URL, timeout=15):
+    """Ask `url` what our public IP is, from inside container (or host if None)"""
+    command = f"curl -s --max-time {timeout} {url}"
+    if container:
+        # Install curl in the container if it's missing (i.e: gluetun), part of the probe so each host checks it's own.
+        # The `-T` in dcp exec is needed. See: https://stackoverflow.com/questions/43099116
+        command = (
+            f"{DCP} exec -T {container} sh -c 'command -v curl >/dev/null || apk add -q curl >/dev/null; {command}'"
+        )
+    try:
+        ret = c.run(command, hide=True, warn=True, timeout=timeout + (30 if container else 10))
+        return json.loads(ret.stdout) if ret.ok else {"error": ret.stderr.strip() or f"exit code {ret.exited}"}
+    except (CommandTimedOut, ValueError) as e:
+        return {"error": str(e)}
+
+
+@task(incrementable=["verbose"], help={"url": "IP echo service, must reply with a json containing `ip`"})
+def vpn(c, verbose=0, full=False, services_config=None, root=None, dcp_path=None, url=IP_ECHO_URL, timeout=15):
     """Test that the VPN is connected and it's IP isn't local"""
     running_services = set(dcp_running_services(c, verbose=False))
     if "gluetun" not in running_services:
         raise ValueError("VPN service must be running. Please first run `dcp up -d gluetun`.")
 
-    # The `-T` in dcp exec is needed. See: https://stackoverflow.com/questions/43099116
-    c.run(f"{DCP} exec -T gluetun sh -c 'apk add curl'", hide=True)
-    vpn = json.loads(c.run(f"{DCP} exec -T gluetun sh -c 'curl https://ipleak.net/json/'", hide=True).stdout)
-    local = json.loads(c.run("curl https://ipleak.net/json/", hide=True).stdout)
-
-    if verbose == 1:
-        _print_dicts(local, vpn, titles=["Local:", "VPN:"])
-
+    usevpn, missing_services = [], []
     if full or verbose > 1:
         services = _load_service_config(services_config, root)
+        compose = _compose_model(dcp_path)
         usevpn = [
-            service
-            for service, v in services.items()
-            if v["enable"] and "usevpn" in _get_service_compose(service, dcp_path=dcp_path)
+            service for service, v in services.items() if v["enable"] and service in compose and compose[service].usevpn
         ]
         missing_services = [service for service in usevpn if service not in running_services]
-        present_services = [service for service in usevpn if service in running_services]
-
-        present_services = {
-            service: json.loads(
-                c.run(
-                    f"{DCP} exec -T {service} sh -c 'curl https://ipleak.net/json/'",
-                    hide=True,
-                ).stdout
-            )
-            for service in present_services
-        }
-
-        if verbose > 1:
-            _print_dicts(
-                local,
-                vpn,
-                *present_services.values(),
-                titles=["Local:", "VPN:"] + [s.title() + ":" for s in present_services],
-            )
-        elif verbose == 1:
-            _print_dicts(local, vpn, titles=["Local:", "VPN:"])
+    present_services = [service for service in usevpn if service in running_services]
+
+    # Probe every container at the same time, each exec takes a few seconds
+    with ThreadPoolExecutor(max_workers=len(present_services) + 2) as executor:
+        local = executor.submit(_probe_ip, c, None, url, timeout)
+        vpn = executor.submit(_probe_ip, c, "gluetun", url, timeout)
+        probes = {service: executor.submit(_probe_ip, c, service, url, timeout) for service in present_services}
+        local, vpn = local.result(), vpn.result()
+        probes = {service: probe.result() for service, probe in probes.items()}
 
-        present_services = {
-            service: local != vpn and s_vpn["ip"] == vpn["ip"] for service, s_vpn in present_services.items()
-        }
+    connected = "ip" in vpn and local.get("ip") != vpn["ip"]
+    result = {
+        "local": local,
+        "vpn": vpn,
+        "connected": connected,
+        "services": {service: connected and probe.get("ip") == vpn["ip"] for service, probe in probes.items()},
+        "missing": missing_services,
+    }
 
-        if any(present_services.values()):
-            print(f"Services that use VPN: {', '.join(s for s, v in present_services.items() if v)}")
-        if not all(present_services.values()):
-            print(f"WARNING: services not using VPN: {', '.join(s for s, v in present_services.items() if not v)}")
+    if verbose > 1:
+        _print_dicts(local, vpn, *probes.values(), titles=["Local:", "VPN:"] + [s.title() + ":" for s in probes])
+    elif verbose == 1:
+        _print_dicts(local, vpn, titles=["Local:", "VPN:"])
+
+    if full or verbose > 1:
+        if any(result["services"].values()):
+            print(f"Services that use VPN: {', '.join(s for s, v in result['services'].items() if v)}")
+        if not all(result["services"].values()):
+            print(f"WARNING: services not using VPN: {', '.join(s for s, v in result['services'].items() if not v)}")
         if missing_services:
             print("WARNING: The following services were not running, so were not checked:")
             print(", ".join(missing_services))
-    print("VPN working correctly." if local != vpn else "VPN not connected!!")
+    print("VPN working correctly." if connected else "VPN not connected!!")
+    return result
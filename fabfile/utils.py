@@ -1,21 +1,43 @@
+import copy
+import hashlib
 import inspect
 import io
 import itertools
 import json
+import os
 import platform
 import posixpath
 import re
+import shlex
+import subprocess
+import threading
+import time
+from collections import Counter, defaultdict, namedtuple
+from functools import lru_cache, wraps
 from pathlib import Path
-from stat import S_ISDIR, S_ISREG
+from stat import S_IFREG, S_ISDIR, S_ISREG
 from xml.etree import ElementTree as ET
 
+import fabric
+import humanize
+import invoke
 import keyring
+import paramiko
 import requests
+from fabric import Connection
 from invoke import Context
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from ruamel.yaml import YAML
 
-from fabfile.defaults import COMPOSE_PATH, LOCAL_ROOT, SERVICES_PATH
+from fabfile.defaults import (
+    BACKUP_PATH,
+    CACHE_PATH,
+    COMPOSE_PATH,
+    LOCAL_ROOT,
+    SERVICES_PATH,
+    TRANSFER_CHUNK_SIZE,
+    TRANSFER_WINDOW,
+)
 
 
 def _get_hostname(c):
@@ -23,6 +45,203 @@ def _get_hostname(c):
     return ips[0]
 
 
+# Connections shared by all tasks of an invocation, keyed by (user, host, port)
+_SESSIONS = {}
+# Number of channels opened and sftp requests made, per top level task
+_ROUND_TRIPS = defaultdict(Counter)
+_CURRENT_TASK = None
+
+
+def _session(c):
+    """Return the connection already used by a previous task for `c`'s host, if any.
+    Fabric creates a new connection for every task given on the command line, this
+    lets `fab status.vpn backup.all configure.homer` share one SSH transport and one
+    SFTP client instead of reconnecting (and re-authenticating) each time. Only meant
+    for those, connections made by the tasks themselves must be left alone."""
+    if type(c) is Context:
+        return c
+    return _SESSIONS.setdefault((c.user, c.host, c.port), c)
+
+
+def _count_round_trips(kind, f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        _ROUND_TRIPS[_CURRENT_TASK or "<none>"][kind] += 1
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+paramiko.Transport.open_session = _count_round_trips("channels", paramiko.Transport.open_session)
+paramiko.SFTPClient._async_request = _count_round_trips("sftp", paramiko.SFTPClient._async_request)
+
+# Opt-in trace of remote calls, a list of chrome trace events once enabled with `_enable_tracing`
+_TRACE = None
+_TRACE_FRAMES = threading.local()
+
+
+def _enable_tracing():
+    global _TRACE
+    if _TRACE is None:
+        _TRACE = []
+    return _TRACE
+
+
+def _trace_bytes(n):
+    """Attribute `n` bytes moved to the innermost traced call of this thread"""
+    if _TRACE is not None and (frames := getattr(_TRACE_FRAMES, "stack", None)):
+        frames[-1]["bytes"] += n
+
+
+def _traced(name, cat="remote", describe=None):
+    """When tracing is enabled, record each call of the decorated function along with its
+    duration, the bytes it moved (see `_trace_bytes`), its callers and the task it ran in."""
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if _TRACE is None:
+                return f(*args, **kwargs)
+            stack = _TRACE_FRAMES.__dict__.setdefault("stack", [])
+            frame = {"name": name, "cat": cat, "bytes": 0}
+            stack.append(frame)
+            start = time.perf_counter()
+            try:
+                ret = f(*args, **kwargs)
+                if isinstance(ret, invoke.Result):
+                    frame["bytes"] += len(ret.stdout) + len(ret.stderr)
+                return ret
+            finally:
+                duration = time.perf_counter() - start
+                path = [fr["name"] for fr in stack]
+                stack.pop()
+                if stack:
+                    stack[-1]["bytes"] += frame["bytes"]
+                if path[0] != _CURRENT_TASK and _CURRENT_TASK:
+                    path.insert(0, _CURRENT_TASK)
+                _TRACE.append(
+                    {
+                        "name": name,
+                        "cat": cat,
+                        "ph": "X",
+                        "ts": start * 1e6,
+                        "dur": duration * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": {
+                            "detail": str(describe(*args, **kwargs)) if describe else "",
+                            "bytes": frame["bytes"],
+                            "stack": path,
+                        },
+                    }
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def _trace_summary(events):
+    """Print a flame graph like tree of time, calls and bytes, per call stack"""
+    totals = defaultdict(lambda: [0, 0.0, 0])
+    for event in events:
+        total = totals[tuple(event["args"]["stack"])]
+        total[0] += 1
+        total[1] += event["dur"] / 1e6
+        total[2] += event["args"]["bytes"]
+
+    def show(prefix):
+        children = [path for path in totals if len(path) == len(prefix) + 1 and path[: len(prefix)] == prefix]
+        for path in sorted(children, key=lambda path: -totals[path][1]):
+            calls, seconds, moved = totals[path]
+            name = "  " * len(prefix) + path[-1]
+            print(f"{name:<50}{seconds:>10.3f}s{calls:>8} calls{humanize.naturalsize(moved):>12}")
+            show(path)
+
+    show(())
+
+
+def _write_chrome_trace(events, path):
+    """Save events in chrome's trace event format, open them with chrome://tracing or ui.perfetto.dev"""
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _describe_first(_, arg=None, *args, **kwargs):
+    return arg
+
+
+for _cls, _prefix in ((Connection, ""), (Context, "local.")):
+    for _method in ("run", "sudo"):
+        setattr(_cls, _method, _traced(_prefix + _method, describe=_describe_first)(getattr(_cls, _method)))
+Connection.get = _traced("get", describe=_describe_first)(Connection.get)
+Connection.put = _traced("put", describe=lambda _, local, remote=None, **kw: f"{local} -> {remote}")(Connection.put)
+Connection.sftp = _traced("sftp", cat="sftp")(Connection.sftp)
+for _method in ("stat", "lstat", "listdir", "listdir_attr", "open", "remove", "rename", "posix_rename", "mkdir"):
+    _traced_method = _traced(f"sftp.{_method}", cat="sftp", describe=_describe_first)
+    setattr(paramiko.SFTPClient, _method, _traced_method(getattr(paramiko.SFTPClient, _method)))
+
+
+def _count_bytes(f, size):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        ret = f(*args, **kwargs)
+        _trace_bytes(size(ret))
+        return ret
+
+    return wrapper
+
+
+# File reads and writes are too fine grained to be events, their bytes go to the enclosing call instead
+paramiko.SFTPFile._read = _count_bytes(paramiko.SFTPFile._read, lambda data: len(data or b""))
+paramiko.SFTPFile._write = _count_bytes(paramiko.SFTPFile._write, lambda n: n)
+
+
+def task(*args, **kwargs):
+    """Drop-in replacement for `fabric.task` which runs the task on the invocation's
+    shared connection (see `_session`) and attributes round trips to it."""
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return task()(args[0])
+
+    def decorator(body):
+        name = f"{body.__module__.split('.')[-1]}.{body.__name__}"
+        traced = _traced(name, cat="task")(body)
+
+        @wraps(body)
+        def wrapper(c, *a, **kw):
+            global _CURRENT_TASK
+            if _CURRENT_TASK is not None:
+                # Called from another task, which may hand out its own connections (i.e: clones used to run
+                # jobs concurrently, fleet's per host connections), use the one given
+                return traced(c, *a, **kw)
+            _CURRENT_TASK = name
+            try:
+                return traced(_session(c), *a, **kw)
+            finally:
+                _CURRENT_TASK = None
+
+        return fabric.task(*args, **kwargs)(wrapper)
+
+    return decorator
+
+
+def _clone_connection(c):
+    """Open another connection to the same host as `c` (with the same config), useful
+    to run things concurrently. Local contexts are returned as is."""
+    if type(c) is Context:
+        return c
+    return Connection(
+        c.host,
+        user=c.user,
+        port=c.port,
+        config=c.config,
+        gateway=c.gateway,
+        forward_agent=c.forward_agent,
+        connect_timeout=c.connect_timeout,
+        connect_kwargs=c.connect_kwargs,
+    )
+
+
 def _dcp_is_up(c):
     ret = c.run("docker-compose top", hide=True, warn=True)
     return ret.ok and ret.stdout
@@ -52,29 +271,98 @@ def _put_mv(c, path_or_data, target_dir, raw=False, filename=None):
     c.sudo(f"mv ~/{filename} {target_dir}", warn=True)
 
 
-def _get_py_version(c):
-    v = c.run("python -V || python3 -V || echo 'Default 0.0.0'", hide=True, warn=True).stdout.split(" ")[-1]
-    return [int(i) for i in v.split(".")]
-
-
 def _get_jinja_env(root=None):
     # Create templating engine environment
     return Environment(loader=FileSystemLoader(root or LOCAL_ROOT), autoescape=select_autoescape())
 
 
-def _load_service_config(services_config=None, root=None):
-    # Preprocess services.yml, fill out any secrets with `keyring`
+_SECRET_RE = re.compile(r"__keyring_([0-9a-f]*)__")
+
+
+@lru_cache(maxsize=None)
+def _keyring_get(service, username):
+    return keyring.get_password(service, username)
+
+
+class _Secret:
+    """A config value containing keyring secrets which are only fetched (once) when the
+    value is actually used, i.e: rendered into a template."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return _SECRET_RE.sub(lambda m: str(_keyring_get(*bytes.fromhex(m[1]).decode().split("\0"))), self.value)
+
+    def __repr__(self):
+        return f"_Secret({self.value!r})"
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __bool__(self):
+        return bool(str(self))
+
+
+def _secret_placeholder(service, username):
+    """Stand-in for `keyring.get_password` that encodes it's arguments in a YAML safe string"""
+    return "__keyring_" + f"{service}\0{username}".encode().hex() + "__"
+
+
+def _with_secrets(value):
+    """Recursively wrap strings that reference a secret in `_Secret`"""
+    if isinstance(value, dict):
+        return {k: _with_secrets(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_with_secrets(v) for v in value]
+    return _Secret(value) if isinstance(value, str) and _SECRET_RE.search(value) else value
+
+
+def _render_service_config(path, services_config=None, root=None, disk_cache=True):
+    """Render and parse the services config with placeholders in place of secrets, the result
+    is secret free so it's cached on disk, keyed on the file's mtime and content hash."""
+    stat = path.stat()
+    cache = CACHE_PATH / f"services-{hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:16]}.json"
+    if disk_cache and cache.exists():
+        with open(cache, "r") as f:
+            cached = json.load(f)
+        if cached["mtime"] == stat.st_mtime_ns or cached["sha256"] == _file_sha256(path):
+            return cached["services"]
+
+    # Preprocess services.yml, fill out any secrets with a placeholder
     env = _get_jinja_env(root)
-    services = env.get_template(services_config or str(SERVICES_PATH), "r")
+    services = env.get_template(services_config or str(SERVICES_PATH))
     services = services.render(
-        keyring_get=keyring.get_password,
+        keyring_get=_secret_placeholder,
         # public_ip=requests.get("https://api.ipify.org").content.decode("utf8"),
     )
 
     # Load services config, expand enable option
     services = YAML(typ="safe").load(services)
     services = {k: v if type(v) is not bool else {"enable": v} for k, v in services.items()}
-    return {k.replace("-", "_"): v for k, v in services.items()}
+    services = {k.replace("-", "_"): v for k, v in services.items()}
+
+    if disk_cache:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache, "w") as f:
+            json.dump({"mtime": stat.st_mtime_ns, "sha256": _file_sha256(path), "services": services}, f)
+    return services
+
+
+_SERVICE_CONFIGS = {}
+
+
+def _load_service_config(services_config=None, root=None, disk_cache=True):
+    """Load services config, secrets are fetched from `keyring` lazily (see `_Secret`).
+    The result is memoized for the whole invocation, a copy is returned so callers can modify it."""
+    path = Path(root or LOCAL_ROOT) / (services_config or str(SERVICES_PATH))
+    key = (str(path.resolve()), path.stat().st_mtime_ns)
+    if key not in _SERVICE_CONFIGS:
+        _SERVICE_CONFIGS[key] = _with_secrets(_render_service_config(path, services_config, root, disk_cache))
+    return copy.deepcopy(_SERVICE_CONFIGS[key])
 
 
 def _read_file(c, path, encoding="utf-8", raw=False):
@@ -84,8 +372,199 @@ def _read_file(c, path, encoding="utf-8", raw=False):
     return f.getvalue().decode(encoding) if not raw else f.getvalue()
 
 
-def _total_files(c, dir):
-    return int(c.run(f"find {dir} -type f | wc -l", hide=True).stdout)
+def _load_transfer_state(path, size, mtime, chunk_size):
+    """Load sidecar state of a partial transfer, discard it if the source changed since"""
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+        if (state["size"], state["mtime"], state["chunk_size"]) == (size, mtime, chunk_size):
+            return state
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    return {"size": size, "mtime": mtime, "chunk_size": chunk_size, "chunks": {}}
+
+
+def _save_transfer_state(path, state):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    Path(f"{path}.tmp").replace(path)
+
+
+def _resumable_get(c, remote, local, chunk_size=TRANSFER_CHUNK_SIZE, window=TRANSFER_WINDOW):
+    """Download `remote` to `local` in chunks of `chunk_size`, `window` chunks at a time
+    with pipelined reads. Finished chunks are recorded (with their hash) in a sidecar
+    `<local>.part.json` file so that an interrupted download can resume."""
+    sftp = c.sftp()
+    attr = sftp.stat(remote)
+    part, state_path = Path(f"{local}.part"), Path(f"{local}.part.json")
+    state = _load_transfer_state(state_path, attr.st_size, attr.st_mtime, chunk_size)
+
+    with open(part, "r+b" if part.exists() else "wb") as f:
+        # Only trust chunks that are still intact on disk
+        for i, digest in list(state["chunks"].items()):
+            f.seek(int(i) * chunk_size)
+            if hashlib.sha256(f.read(chunk_size)).hexdigest() != digest:
+                del state["chunks"][i]
+
+        todo = [i for i in range(-(-attr.st_size // chunk_size)) if str(i) not in state["chunks"]]
+        with sftp.open(remote, "rb") as remote_f:
+            for batch in (todo[i : i + window] for i in range(0, len(todo), window)):
+                ranges = [(i * chunk_size, min(chunk_size, attr.st_size - i * chunk_size)) for i in batch]
+                for i, data in zip(batch, remote_f.readv(ranges)):
+                    f.seek(i * chunk_size)
+                    f.write(data)
+                    state["chunks"][str(i)] = hashlib.sha256(data).hexdigest()
+                f.flush()
+                os.fsync(f.fileno())
+                _save_transfer_state(state_path, state)
+        f.truncate(attr.st_size)
+
+    part.replace(local)
+    state_path.unlink(missing_ok=True)
+    return attr.st_size
+
+
+def _resumable_put(c, local, remote, chunk_size=TRANSFER_CHUNK_SIZE, window=TRANSFER_WINDOW):
+    """Upload `local` to `remote` in chunks of `chunk_size` using pipelined writes. After
+    every `window` chunks the remote size is checked and the confirmed chunks recorded in
+    a sidecar `<local>.put.json` file so that an interrupted upload can resume."""
+    sftp = c.sftp()
+    stat = os.stat(local)
+    part, state_path = f"{remote}.part", Path(f"{local}.put.json")
+    state = _load_transfer_state(state_path, stat.st_size, stat.st_mtime, chunk_size)
+    if state.get("remote") != remote:
+        state.update(remote=remote, chunks={})
+
+    def end(i):
+        return min((int(i) + 1) * chunk_size, stat.st_size)
+
+    # Chunks past what actually made it to the remote need to be resent
+    try:
+        remote_size, exists = sftp.stat(part).st_size, True
+    except FileNotFoundError:
+        remote_size, exists = 0, False
+    state["chunks"] = {i: v for i, v in state["chunks"].items() if end(i) <= remote_size}
+
+    todo = [i for i in range(-(-stat.st_size // chunk_size)) if str(i) not in state["chunks"]]
+    with open(local, "rb") as f:
+        for batch in [todo[i : i + window] for i in range(0, len(todo), window)] or [[]]:
+            # Closing the remote file waits for all pipelined writes to be acknowledged
+            with sftp.open(part, "r+" if exists else "w") as remote_f:
+                remote_f.set_pipelined(True)
+                for i in batch:
+                    f.seek(i * chunk_size)
+                    remote_f.seek(i * chunk_size)
+                    remote_f.write(f.read(chunk_size))
+            exists, confirmed = True, sftp.stat(part).st_size
+            state["chunks"].update({str(i): True for i in batch if end(i) <= confirmed})
+            _save_transfer_state(state_path, state)
+
+    if any(str(i) not in state["chunks"] for i in todo):
+        raise IOError(f"Failed to upload {local}, run again to resume.")
+    sftp.truncate(part, stat.st_size)
+    sftp.posix_rename(part, remote)
+    state_path.unlink(missing_ok=True)
+    return stat.st_size
+
+
+def _file_sha256(path, bufsize=2**20):
+    """Hash a local file (or binary file object) without reading it all in memory"""
+    if isinstance(path, (str, os.PathLike)):
+        with open(path, "rb") as f:
+            return _file_sha256(f, bufsize)
+    h = hashlib.sha256()
+    while chunk := path.read(bufsize):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def _stream_command(c, command, out, bufsize=2**16, callback=None):
+    """Run `command` and write it's (binary) stdout to the file-like `out` as it arrives,
+    holding at most `bufsize` bytes in memory. Returns the number of bytes written."""
+    if type(c) is Context:
+        proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        recv, stderr, wait = proc.stdout.read, proc.stderr.read, proc.wait
+    else:
+        c.open()
+        channel = c.client.get_transport().open_session()
+        channel.exec_command(command)
+        recv, stderr, wait = channel.recv, lambda: channel.recv_stderr(bufsize), channel.recv_exit_status
+
+    total = 0
+    while chunk := recv(bufsize):
+        out.write(chunk)
+        total += len(chunk)
+        if callback:
+            callback(len(chunk))
+    if status := wait():
+        raise RuntimeError(f"Command `{command}` exited with {status}: {stderr().decode(errors='replace')}")
+    return total
+
+
+def _feed_command(c, command, produce, sudo=False, bufsize=2**16):
+    """Run `command` with a stdin fed by `produce(write)` as it writes, instead of uploading a file
+    first. With `sudo` the command runs as root, the sudo password (if any) is sent ahead of the data
+    and read by sudo (dropped if none is needed), not by `command`. Returns the number of bytes written."""
+    password = c.config.sudo.password if sudo else None
+    if password:
+        # The same sudo has to read the password and run the command, without a tty sudo ties cached
+        # credentials to the parent process so a `sudo -v` beforehand isn't enough
+        command = (
+            f"if sudo -n true 2>/dev/null; then IFS= read -r _; exec sudo -n {command}; "
+            f"else exec sudo -S -k -p '' {command}; fi"
+        )
+    elif sudo:
+        command = f"sudo -n {command}"
+
+    if type(c) is Context:
+        proc = subprocess.Popen(command, shell=True, bufsize=0, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        send, close, stderr, wait = proc.stdin.write, proc.stdin.close, proc.stderr.read, proc.wait
+    else:
+        c.open()
+        channel = c.client.get_transport().open_session()
+        channel.exec_command(command)
+        send, close, stderr, wait = (
+            channel.sendall,
+            channel.shutdown_write,
+            lambda: channel.recv_stderr(bufsize),
+            channel.recv_exit_status,
+        )
+
+    def failed(status):
+        return RuntimeError(f"Command `{command}` exited with {status}: {stderr().decode(errors='replace')}")
+
+    total = 0
+
+    def write(data):
+        nonlocal total
+        try:
+            send(data)
+        except OSError:
+            # The command exited early, it's error is more useful than a broken pipe
+            if status := wait():
+                raise failed(status) from None
+            raise
+        total += len(data)
+
+    try:
+        if password:
+            send(f"{password}\n".encode())
+        produce(write)
+    finally:
+        close()
+    if status := wait():
+        raise failed(status)
+    return total
+
+
+def _run_sections(c, commands, **kwargs):
+    """Run a dict of {name: command} in a single round trip, return {name: stdout}.
+    Errors are ignored, a failing command just has an empty (or partial) output."""
+    marker = "@@section@@"
+    script = "; ".join(f"echo '{marker}{name}'; {{ {command} ; }} 2>/dev/null" for name, command in commands.items())
+    out = c.run(script, hide=True, warn=True, **kwargs).stdout
+    sections = (section.partition("\n") for section in out.split(marker)[1:])
+    return {name.strip(): body.strip() for name, _, body in sections}
 
 
 def _get_xml_value(c, path, key, encoding="utf-8", default=None):
@@ -97,22 +576,77 @@ def _get_xml_value(c, path, key, encoding="utf-8", default=None):
         return default
 
 
+RemoteFile = namedtuple("RemoteFile", ["path", "size", "mtime", "mode"])
+ListingDiff = namedtuple("ListingDiff", ["added", "modified", "deleted", "bytes"])
+
+
+def _listing(files, root, excluded=None):
+    """Compact, json-able, listing of a remote tree as returned by `_remote_walk`"""
+    return {
+        "root": root,
+        "excluded": list(excluded or []),
+        "time": time.time(),
+        "files": {posixpath.relpath(f.path, root): [f.size, f.mtime] for f in files},
+    }
+
+
+def _diff_listings(old, new):
+    """Compare two listings, return the added, modified and deleted paths and the bytes that changed"""
+    old, new = old["files"], new["files"]
+    added, deleted = sorted(new.keys() - old.keys()), sorted(old.keys() - new.keys())
+    modified = sorted(path for path in new.keys() & old.keys() if new[path] != old[path])
+    return ListingDiff(added, modified, deleted, sum(new[path][0] for path in added + modified))
+
+
+def _previous_listing(service, directory=None):
+    """Return (snapshot, listing) of the most recent backup of `service` other than `directory`, or (None, None)"""
+    for path in sorted(BACKUP_PATH.glob(f"*/{service}.listing.json"), reverse=True):
+        if path.parent.name != (directory or ""):
+            with open(path, "r") as f:
+                return path.parent, json.load(f)
+    return None, None
+
+
 def _remote_walk(c, root, exclude_dirs=None):
-    """Like os.walk but for the remote host!"""
-    exclude_dirs = set(exclude_dirs or [])
-    root = c.sftp().normalize(root)
-    for entry in c.sftp().listdir(root):
-        pathname = posixpath.join(root, entry)
-        mode = c.sftp().stat(pathname).st_mode
-        if S_ISDIR(mode):
+    """Like os.walk but for the remote host! Lists the whole tree in a single
+    `find` call and yields a `RemoteFile(path, size, mtime, mode)` per regular file."""
+    exclude_dirs = [d.rstrip("/") for d in exclude_dirs or []]
+    prune = "".join(f"-path {shlex.quote(d)} -prune -o " for d in exclude_dirs)
+    ret = c.run(
+        f"find -H {shlex.quote(root.rstrip('/') or '/')} {prune}-type f -printf '%s %T@ %m %p\\0'",
+        hide=True,
+        warn=True,
+    )
+    if ret.failed and not ret.stdout:
+        # Probably a `find` without `-printf` (i.e: busybox), fallback to sftp
+        yield from _remote_walk_sftp(c, root, exclude_dirs=exclude_dirs)
+        return
+    if ret.failed:
+        # Some of the tree couldn't be listed (i.e: permission denied), don't go on with a partial listing
+        raise IOError(f"Failed to list {root}: {ret.stderr.strip()}")
+    for line in ret.stdout.split("\0"):
+        if line:
+            size, mtime, mode, path = line.split(" ", 3)
+            yield RemoteFile(path, int(size), float(mtime), S_IFREG | int(mode, 8))
+
+
+def _remote_walk_sftp(c, root, exclude_dirs=None):
+    """Slower version of `_remote_walk` that uses one sftp `listdir_attr` per directory"""
+    sftp = c.sftp()
+    exclude_dirs = set(d.rstrip("/") for d in exclude_dirs or [])
+    root = sftp.normalize(root)
+    for attr in sftp.listdir_attr(root):
+        pathname = posixpath.join(root, attr.filename)
+        if S_ISDIR(attr.st_mode):
             # It's a directory!
             if pathname not in exclude_dirs:
-                yield from _remote_walk(c, pathname, exclude_dirs=exclude_dirs)
-        elif S_ISREG(mode):
+                yield from _remote_walk_sftp(c, pathname, exclude_dirs=exclude_dirs)
+        elif S_ISREG(attr.st_mode):
             # It's a file!
-            yield pathname
+            yield RemoteFile(pathname, attr.st_size, attr.st_mtime, attr.st_mode)
 
 
+@_traced("_run", describe=_describe_first)
 def _run(c, command, sudo=False, **kwargs):
     """Alternative to c.run which works on windows"""
     # If running locally (i.e: no host was specified) then c
@@ -125,41 +659,97 @@ def _run(c, command, sudo=False, **kwargs):
     return c.run(command, pty=platform.system() != "Windows", **kwargs)
 
 
-def _print_or_call(f):
-    if callable(f):
-        f()
-    elif f:
-        print(f)
-
-
-def _check_run(
-    c,
-    check,
-    commands,
-    on_success=None,
-    on_fail=None,
-    force=False,
-    sudo=False,
-    check_sudo=False,
-):
-    """Run commands only if check passes (no-error)"""
-    if _run(c, check, hide=True, warn=True, sudo=check_sudo).failed or force:
-        if type(commands) is str:
-            _run(c, commands, sudo=sudo)
-        else:
-            for command in commands:
-                _run(c, command, sudo=sudo)
-        _print_or_call(on_success)
-    else:
-        _print_or_call(on_fail)
+ComposeService = namedtuple("ComposeService", ["name", "text", "usevpn", "image", "ports", "volumes", "merges"])
+_COMPOSE_MODELS = {}
+
+
+def _parse_compose_yaml(text):
+    """Parse a fragment of the compose template as YAML, ignoring jinja tags and aliases"""
+    text = "\n".join(line for line in text.splitlines() if not line.strip().startswith("{%"))
+    text = re.sub(r"{{\s*(.*?)\s*}}", r"${\1}", text)
+    text = re.sub(r"^\s*<<:\s*\*\w+\s*$", "", text, flags=re.MULTILINE)
+    return YAML(typ="safe").load(re.sub(r"&\w+", "", text)) or {}
+
+
+def _compose_model(dcp_path=None):
+    """Parse the compose template into a {service: ComposeService} index, where service is
+    the name used in the template's `{% if <service>.enable %}` block. Memoized per file mtime."""
+    path = Path(dcp_path or str(COMPOSE_PATH))
+    key = (str(path.resolve()), path.stat().st_mtime_ns)
+    if key in _COMPOSE_MODELS:
+        return _COMPOSE_MODELS[key]
+
+    with open(path, "r") as f:
+        header, _, body = f.read().partition("\nservices:")
+
+    # Top level `x-<name>: &<name>` extension fields, only keep the ones that are plain YAML
+    anchors = {}
+    for block in re.split(r"\n(?=x-)", header):
+        if m := re.match(r"x-[\w-]+:\s*&(\w+)", block.strip()):
+            try:
+                anchors[m[1]] = next(iter(_parse_compose_yaml(block.strip()).values()))
+            except Exception:
+                anchors[m[1]] = {}
+
+    # Split body into (possibly nested) `{% if service.enable %}` blocks
+    blocks, name, depth = {}, None, 0
+    for line in body.splitlines(keepends=True):
+        if depth == 0 and (m := re.match(r"\s*{%-?\s+if\s+(\w+)\.enable\s+%}\s*$", line, re.IGNORECASE)):
+            name, depth = m[1].lower(), 1
+            blocks[name] = ""
+            continue
+        if depth and re.match(r"\s*{%-?\s+if\s", line):
+            depth += 1
+        elif depth and re.match(r"\s*{%-?\s+endif\s", line):
+            depth -= 1
+            if depth == 0:
+                continue
+        if depth:
+            blocks[name] += line
+
+    model = {}
+    for name, text in blocks.items():
+        text = inspect.cleandoc("\n" + text)
+        merges = re.findall(r"<<:\s*\*(\w+)", text)
+        config = next(iter(_parse_compose_yaml(text).values()), None) or {}
+        ports = [str(p) for merge in merges for p in anchors.get(merge, {}).get("ports", [])]
+        model[name] = ComposeService(
+            name=name,
+            text=text,
+            usevpn="usevpn" in merges,
+            image=config.get("image"),
+            ports=ports + [str(p) for p in config.get("ports", [])],
+            volumes=[str(v) for v in config.get("volumes", [])],
+            merges=merges,
+        )
+    _COMPOSE_MODELS[key] = model
+    return model
+
+
+def _changed_compose_services(old, new):
+    """Compare two rendered compose files (text), return the (changed or added, removed) service names.
+    Anchors and merge keys are resolved first, so editing a shared `x-` block marks every service using it.
+    Services that depend on, or share the network of (`network_mode: service:<name>`), a changed one are
+    included too, they would otherwise stay attached to the old container's network namespace."""
+    old, new = ((YAML(typ="safe").load(text or "") or {}).get("services") or {} for text in (old, new))
+
+    def needs(config):
+        mode = str(config.get("network_mode") or "")
+        return set(config.get("depends_on") or []) | (
+            {mode[len("service:") :]} if mode.startswith("service:") else set()
+        )
+
+    changed = {name for name, config in new.items() if old.get(name) != config}
+    while dependents := {name for name, config in new.items() if name not in changed and needs(config) & changed}:
+        changed |= dependents
+    return sorted(changed), sorted(set(old) - set(new))
 
 
 def _get_service_compose(service, dcp_path=None):
     """Given a service name, extract it's docker compose config as text"""
-    with open(dcp_path or str(COMPOSE_PATH), "r") as f:
-        pattern = rf"{{%-?\s+if\s+{service.lower()}\.enable\s+%}}(.*?){{%-?\s+endif\s+%}}"
-        matches = re.findall(pattern, f.read(), re.IGNORECASE | re.DOTALL)
-        return inspect.cleandoc(matches[0]) if matches else "Compose not found!"
+    if compose := _compose_model(dcp_path).get(service.lower()):
+        return compose.text
+    return "Compose not found!"
 
 
 def _print_dicts(*dicts, titles=None, sep="\t", sort_keys=True, indent=2):